@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+from cartesian_bot_kf import CartesianBotKF, default_var
+import cartesian_bot_kf
+import argparse
+import math
+import time
+import tracemalloc
+import numpy
+
+# motor parameters
+K = 0.01
+J = 0.01
+b = 0.1
+R = 1
+L = 0.5
+
+# wheel radius
+r = 0.25
+
+# traceback depth kept by tracemalloc, enough to reach advance_filter
+# from any allocation inside the filter
+trace_frames = 16
+
+class AllocatingCartesianBotKF(CartesianBotKF):
+    # the original predict/update, which builds fresh arrays for every
+    # matrix and intermediate on every step; kept as the baseline the
+    # in-place filter is compared against
+    def _predict(self, timestamp, v_x, v_y,
+                 var_vx = default_var, var_vy = default_var):
+        delta_t = timestamp - self.time
+        self.time = timestamp
+        u = numpy.array([[ v_x ],
+                         [ v_y ]])
+        sigma_u = numpy.array([[var_vx, 0],
+                               [0, var_vy]])
+        self.predicted_state = self.A_matrix(delta_t) @ \
+            self.state + self.B_matrix(delta_t) @ u
+        self.predicted_state_cov = \
+            self.A_matrix(delta_t) @ self.state_cov @ \
+            self.A_matrix(delta_t).transpose() + \
+            self.B_matrix(delta_t) @ sigma_u @ \
+            self.B_matrix(delta_t).transpose()
+
+    def _measure(self, z_x, z_y,
+                 var_zx = default_var, var_zy = default_var,
+                 rho_zxy = 0):
+        sigma_z = numpy.array([
+            [var_zx, rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy)],
+            [rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy), var_zy]])
+        z = numpy.array([[z_x],
+                         [z_y]])
+        SigmaXCT =  self.predicted_state_cov @ self.C_matrix().transpose()
+        CSigmaXCT = self.C_matrix() @ SigmaXCT
+        K = SigmaXCT @ numpy.linalg.inv(CSigmaXCT + sigma_z)
+        self.state = self.predicted_state + K @ \
+            (z - self.C_matrix() @ self.predicted_state)
+        self.state_cov = (numpy.identity(6) - K @ self.C_matrix()) @ \
+            self.predicted_state_cov
+
+def measure(botkf, steps, tstep, rho):
+    botkf.set_state(0)
+
+    def step(i):
+        botkf.advance_filter(i * tstep, 10, 5, 0.1, 0.2,
+                             0.1, 0.2, 0.05, 0.07, rho)
+
+    # warm up (fills the transition cache)
+    for i in range(1, 101):
+        step(i)
+
+    start = time.perf_counter()
+    for i in range(101, 101 + steps):
+        step(i)
+    latency = (time.perf_counter() - start) / steps
+
+    # allocation over a shorter run: traces are cleared before every
+    # step, so the peak is the step's transient memory. tracemalloc only
+    # sees blocks that are still live, so the count is of the blocks the
+    # filter allocated during the step and still holds after it (the
+    # arrays the baseline rebinds on every step); temporaries freed
+    # within the step show up in the peak only. Frames are kept so the
+    # count can be limited to allocations made under advance_filter,
+    # leaving out the loop's own objects.
+    tracemalloc.start(trace_frames)
+    alloc_steps = min(steps, 1000)
+    total_bytes = 0
+    total_blocks = 0
+    in_filter = [ tracemalloc.Filter(True, cartesian_bot_kf.__file__,
+                                     all_frames = True) ]
+    for i in range(101 + steps, 101 + steps + alloc_steps):
+        tracemalloc.clear_traces()
+        step(i)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(in_filter)
+        total_bytes += peak
+        total_blocks += len(snapshot.traces)
+    tracemalloc.stop()
+    return latency, total_bytes / alloc_steps, total_blocks / alloc_steps
+
+parser = argparse.ArgumentParser(
+    description = 'Measures per-step latency and memory allocation of '
+    'CartesianBotKF.advance_filter, against a baseline running the '
+    'original allocating predict/update. Memory is the peak traced '
+    'bytes within a step and the number of blocks the filter allocated '
+    'during a step and still holds after it.')
+parser.add_argument('--steps', type=int, default=20000,
+                    help='number of filter steps to time')
+parser.add_argument('--tstep', type=float, default=0.02,
+                    help='time step')
+parser.add_argument('--rho', type=float, default=0.3,
+                    help='measurement noise correlation')
+parser.add_argument('--decoupled', action='store_true',
+                    help='use the axis-decoupled filter mode')
+parser.add_argument('--steadystate', action='store_true',
+                    help='use the steady-state gain mode')
+args = parser.parse_args()
+
+botkf = CartesianBotKF(K, J, b, R, L, r, decoupled = args.decoupled,
+                       steady_state = args.steadystate)
+filters = [ ('baseline', AllocatingCartesianBotKF(K, J, b, R, L, r)),
+            ('in-place', botkf) ]
+
+print('steps: {}'.format(args.steps))
+print('{:>10} {:>12} {:>16} {:>16}'.format(
+    'filter', 'us/step', 'peak bytes/step', 'blocks left/step'))
+for name, kf in filters:
+    latency, peak_bytes, blocks = measure(kf, args.steps, args.tstep,
+                                          args.rho)
+    print('{:>10} {:>12.2f} {:>16.0f} {:>16.2f}'.format(
+        name, latency * 1e6, peak_bytes, blocks))
+print('cache hits/misses: {}/{}'.format(botkf.cache_hits, botkf.cache_misses))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import collections
+import heapq
+import itertools
+import time
+from cartesian_bot_kf import default_var
+
+default_reorder_delay = 0.2
+default_max_pending = 1024
+default_max_history = 256
+
+class CartesianBotIngest:
+    def __init__(self, estimator, reorder_delay = default_reorder_delay,
+                 max_pending = default_max_pending,
+                 max_history = default_max_history,
+                 on_estimate = None):
+        # estimator is an initialized CartesianBotKF. Inputs and
+        # measurements are held in a time-ordered queue until they are
+        # reorder_delay older than the newest timestamp seen (or the
+        # queue is full), then applied in order. Inputs are zero-order
+        # held: a voltage applies from its timestamp until the next one.
+        # A measurement older than what the filter has already processed
+        # rolls the filter back to the last checkpoint before it and
+        # re-applies everything since.
+        if estimator.time is None:
+            raise RuntimeError('uninitialized filter')
+        self.estimator = estimator
+        self.reorder_delay = reorder_delay
+        self.max_pending = max_pending
+        self.on_estimate = on_estimate
+        self._pending = []
+        self._seq = itertools.count()
+        self._newest = estimator.time
+        self._input = (0, 0, default_var, default_var)
+        # every processed event with the filter checkpoint taken right
+        # after it; _base is the checkpoint preceding the oldest entry
+        self._history = collections.deque()
+        self._max_history = max_history
+        self._base = (estimator.checkpoint(), self._input)
+        self.processed = 0
+        self.rollbacks = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def put_input(self, timestamp, v_x, v_y,
+                  var_vx = default_var, var_vy = default_var):
+        self._put(timestamp, 'input', (v_x, v_y, var_vx, var_vy))
+
+    def put_measurement(self, timestamp, z_x, z_y,
+                        var_zx = default_var, var_zy = default_var,
+                        rho_zxy = 0):
+        self._put(timestamp, 'measurement',
+                  (z_x, z_y, var_zx, var_zy, rho_zxy))
+
+    def _put(self, timestamp, kind, payload):
+        event = (timestamp, next(self._seq), kind, payload, time.monotonic())
+        if timestamp < self.estimator.time:
+            self._late(event)
+        else:
+            heapq.heappush(self._pending, event)
+            self.max_depth = max(self.max_depth, len(self._pending))
+        self._newest = max(self._newest, timestamp)
+        self._drain(self._newest - self.reorder_delay)
+
+    def _drain(self, watermark):
+        while self._pending and (self._pending[0][0] <= watermark or
+                                 len(self._pending) > self.max_pending):
+            self._apply(heapq.heappop(self._pending))
+
+    def flush(self):
+        self._drain(float('inf'))
+
+    def _apply(self, event, replay = False):
+        timestamp, _, kind, payload, arrival = event
+        estimator = self.estimator
+        v_x, v_y, var_vx, var_vy = self._input
+        if kind == 'input':
+            if timestamp > estimator.time:
+                estimator.advance_prediction(timestamp, v_x, v_y,
+                                             var_vx, var_vy)
+            self._input = payload
+        else:
+            estimator.advance_filter(timestamp, v_x, v_y, *payload[0:2],
+                                     var_vx, var_vy, *payload[2:])
+            if self.on_estimate is not None:
+                self.on_estimate(timestamp, estimator.state,
+                                 estimator.state_cov)
+        if not replay:
+            self.processed += 1
+            latency = time.monotonic() - arrival
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        self._history.append((event, estimator.checkpoint(), self._input))
+        if len(self._history) > self._max_history:
+            _, checkpoint, held_input = self._history.popleft()
+            self._base = (checkpoint, held_input)
+
+    def _late(self, event):
+        timestamp = event[0]
+        base_checkpoint, base_input = self._base
+        if timestamp < base_checkpoint[0]:
+            # older than anything we can roll back to
+            self.dropped += 1
+            return
+        # keep the newest checkpoint at or before the late event and
+        # collect everything processed after it for re-application
+        replay = [event]
+        while self._history and self._history[-1][0][0] > timestamp:
+            replay.append(self._history.pop()[0])
+        if self._history:
+            _, checkpoint, held_input = self._history[-1]
+        else:
+            checkpoint, held_input = base_checkpoint, base_input
+        self.estimator.restore(checkpoint)
+        self._input = held_input
+        self.rollbacks += 1
+        replay.sort(key = lambda e: (e[0], e[1]))
+        for e in replay:
+            self._apply(e, replay = e is not event)
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'rollbacks': self.rollbacks,
+            'dropped': self.dropped,
+            'queue_depth': len(self._pending),
+            'max_queue_depth': self.max_depth,
+            'mean_latency': self.total_latency / self.processed
+                if self.processed else 0,
+            'max_latency': self.max_latency,
+        }
+
+    async def run(self, queue):
+        # consume ('input' | 'measurement', timestamp, *values) tuples
+        # from an asyncio.Queue until a None sentinel arrives
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    self.flush()
+                    return self.stats()
+                kind, timestamp, *values = item
+                if kind == 'input':
+                    self.put_input(timestamp, *values)
+                else:
+                    self.put_measurement(timestamp, *values)
+            finally:
+                queue.task_done()
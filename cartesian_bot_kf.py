@@ -2,24 +2,96 @@
 
 import numpy
 import math
+import collections
+import scipy.linalg
 
 default_var = 0.25
 default_time_step = 1 / 50
+default_cache_size = 8
+# timestamp differences carry rounding noise, so delta_t values closer
+# than this share a cache entry
+cache_time_resolution = 1e-9
+# relative covariance change between convergence tests below which
+# the filter is considered to have reached steady state
+steady_state_tol = 1e-8
+# steps between steady-state convergence tests
+steady_state_check_interval = 10
+# number of steps simulate_trajectory() advances with one set of
+# cached matrix powers when the time step is uniform
+trajectory_block_size = 64
 
 class CartesianBotKF:
     def __init__(self, torque_const, rotor_inertia, friction_const,
-                 armature_res, armature_ind, wheel_radius):
+                 armature_res, armature_ind, wheel_radius,
+                 decoupled = False, cache_size = default_cache_size,
+                 steady_state = False):
         self.K = torque_const
         self.J = rotor_inertia
         self.b = friction_const
         self.R = armature_res
         self.L = armature_ind
         self.r = wheel_radius
+        # state, covariance and every intermediate live in buffers that
+        # are allocated here once and then updated in place
         self.state = numpy.zeros((6, 1))
         self.state_cov = numpy.identity(6) * default_var
         self.predicted_state = numpy.zeros((6, 1))
         self.predicted_state_cov = numpy.identity(6) * default_var
+        self._work = numpy.empty((6, 6))
+        self._prior_state_cov = numpy.empty((6, 6))
+        self._sigma_h = numpy.empty(6)
+        self._k = numpy.empty(6)
+        # column and row views for forming k SigmaH^T with a matmul into
+        # the work buffer (numpy.outer and broadcasting both allocate
+        # temporaries of their own)
+        self._k_column = self._k[:, None]
+        self._sigma_h_row = self._sigma_h[None, :]
+        self._innovation = numpy.empty((2, 1))
         self.time = None
+        # x (states 0-2) and y (states 3-5) chains only interact through
+        # correlated measurement noise. In decoupled mode, as long as no
+        # correlated measurement has made the x-y cross-covariance block
+        # nonzero, the innovation covariance is diagonal and the update
+        # takes both components at once instead of one after the other.
+        # Prediction always runs on the full 6x6 matrices: batching the
+        # two 3x3 blocks measured slower than the three 6x6 matmuls, and
+        # A is block diagonal, so zero cross blocks stay zero anyway.
+        self.decoupled = decoupled
+        self.cross_cov = False
+        # C Sigma (rows 0 and 3 of the predicted covariance), copied out
+        # of a view made once: matmul allocates more on the strided view,
+        # and numpy keeps the shape block of a view made per step
+        self._predicted_cov_rows = self.predicted_state_cov[0::3, :]
+        self._cov_rows = numpy.empty((2, 6))
+        # C never changes; A and B only depend on delta_t and the motor
+        # parameters, which in practice take one of a few values
+        self.C = self.C_matrix()
+        self.CT = self.C.transpose()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = collections.OrderedDict()
+        self._power_cache = collections.OrderedDict()
+        self._cache_params = None
+        # with constant delta_t and noise parameters the covariance
+        # converges; in steady-state mode the filter notices that, freezes
+        # the gain and from then on only updates the state until
+        # delta_t or a noise parameter changes. Online convergence takes
+        # thousands of steps (the motor current is weakly observable), so
+        # when the rate and noise are known up front, solve_steady_state()
+        # is the way to start out frozen.
+        self.steady_state = steady_state
+        self.gain = numpy.zeros((6, 2))
+        self._ss_key = None
+        self._ss_gain = None
+        self._ss_steps = 0
+
+    def _reset_state_cov(self):
+        self.state_cov.fill(0)
+        numpy.fill_diagonal(self.state_cov, default_var)
+        self.cross_cov = False
+        self._ss_key = None
+        self._ss_gain = None
 
     def set_state(self, timestamp,
                   position_x = 0, position_y = 0,
@@ -32,7 +104,7 @@ class CartesianBotKF:
         self.state[3, 0] = position_y
         self.state[4, 0] = wheel_ang_vel_y
         self.state[5, 0] = motor_current_y
-        self.state_cov = numpy.identity(6) * default_var
+        self._reset_state_cov()
 
     def A_matrix(self, delta_t = default_time_step):
         A = numpy.identity(6)
@@ -43,6 +115,17 @@ class CartesianBotKF:
         A[2, 2] = A[5, 5] = 1 - delta_t * self.R / self.L
         return A
 
+    def A_matrices(self, delta_t):
+        # A_matrix() for every element of an array of time steps
+        delta_t = numpy.asarray(delta_t, dtype = float)
+        A = numpy.tile(numpy.identity(6), delta_t.shape + (1, 1))
+        A[..., 0, 1] = A[..., 3, 4] = self.r * delta_t
+        A[..., 1, 1] = A[..., 4, 4] = 1 - delta_t * self.b / self.J
+        A[..., 1, 2] = A[..., 4, 5] = delta_t * self.K / self.J
+        A[..., 2, 1] = A[..., 5, 4] = -delta_t * self.K / self.L
+        A[..., 2, 2] = A[..., 5, 5] = 1 - delta_t * self.R / self.L
+        return A
+
     def B_matrix(self, delta_t = default_time_step):
         B = numpy.zeros((6, 2))
         B[2, 0] = B[5, 1] = delta_t / self.L
@@ -54,27 +137,60 @@ class CartesianBotKF:
         C[1, 3] = 1
         return C
 
+    def _motor_params(self):
+        return self.K, self.J, self.b, self.R, self.L, self.r
+
+    def clear_transition_cache(self):
+        self._cache.clear()
+        self._power_cache.clear()
+        self._cache_params = None
+
+    def _check_cache_params(self):
+        params = self._motor_params()
+        if params != self._cache_params:
+            self._cache.clear()
+            self._power_cache.clear()
+            self._cache_params = params
+        return params
+
+    def _transition(self, delta_t):
+        params = self._check_cache_params()
+        key = (round(delta_t / cache_time_resolution),) + params
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return entry
+        self.cache_misses += 1
+        A = self.A_matrix(delta_t)
+        # B only feeds the voltages into the motor currents (states 2
+        # and 5) with gain g, so B sigma_u B^T is g^2 * var_v on those
+        # two diagonal entries
+        g = self.B_matrix(delta_t)[2, 0]
+        entry = (A, A.transpose().copy(), g)
+        self._cache[key] = entry
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last = False)
+        return entry
+
     def _predict(self, timestamp, v_x, v_y,
                  var_vx = default_var, var_vy = default_var):
         if self.time is None:
             raise RuntimeError('uninitialized filter')
         delta_t = timestamp - self.time
         self.time = timestamp
-        u = numpy.array([[ v_x ],
-                         [ v_y ]])
-        sigma_u = numpy.array([[var_vx, 0],
-                               [0, var_vy]])
-        self.predicted_state = self.A_matrix(delta_t) @ \
-            self.state + self.B_matrix(delta_t) @ u
-        self.predicted_state_cov = \
-            self.A_matrix(delta_t) @ self.state_cov @ \
-            self.A_matrix(delta_t).transpose() + \
-            self.B_matrix(delta_t) @ sigma_u @ \
-            self.B_matrix(delta_t).transpose()
+        A, AT, g = self._transition(delta_t)
+        numpy.matmul(A, self.state, out = self.predicted_state)
+        numpy.matmul(A, self.state_cov, out = self._work)
+        numpy.matmul(self._work, AT, out = self.predicted_state_cov)
+        self.predicted_state[2, 0] += g * v_x
+        self.predicted_state[5, 0] += g * v_y
+        self.predicted_state_cov[2, 2] += g * g * var_vx
+        self.predicted_state_cov[5, 5] += g * g * var_vy
 
     def _skip_measure(self):
-        self.state = self.predicted_state
-        self.state_cov = numpy.identity(6) * default_var
+        numpy.copyto(self.state, self.predicted_state)
+        self._reset_state_cov()
 
     def peek_pos(self):
         return self.state[0, 0], self.state[3, 0]
@@ -88,17 +204,389 @@ class CartesianBotKF:
     def _measure(self, z_x, z_y,
                  var_zx = default_var, var_zy = default_var,
                  rho_zxy = 0):
-        sigma_z = numpy.array([
-            [var_zx, rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy)],
-            [rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy), var_zy]])
-        z = numpy.array([[z_x],
-                         [z_y]])
-        SigmaXCT =  self.predicted_state_cov @ self.C_matrix().transpose()
-        CSigmaXCT = self.C_matrix() @ SigmaXCT
-        K = SigmaXCT @ numpy.linalg.inv(CSigmaXCT + sigma_z)
+        if self.decoupled and rho_zxy == 0 and not self.cross_cov:
+            self._measure_decoupled(z_x, z_y, var_zx, var_zy)
+            return
+        # C only picks states 0 and 3. Regressing z_y on z_x decorrelates
+        # the measurement noise, after which the two components can be
+        # applied as successive scalar updates without any inversion:
+        # z_x = x0 + n_x and z_y - a z_x = x3 - a x0 + n_y', where
+        # a = cov(z_x, z_y) / var_zx and var(n_y') = (1 - rho^2) var_zy.
+        # An exact x fix (var_zx = 0) has no noise for n_y to correlate
+        # with, so z_y is then applied as it is
+        numpy.copyto(self.state, self.predicted_state)
+        numpy.copyto(self.state_cov, self.predicted_state_cov)
+        if rho_zxy == 0 or var_zx == 0:
+            a = 0
+            var_zy_given_zx = var_zy
+        else:
+            a = rho_zxy * math.sqrt(var_zy / var_zx)
+            var_zy_given_zx = (1 - rho_zxy * rho_zxy) * var_zy
+        self._scalar_update(z_x, 0, 0, var_zx)
+        self._scalar_update(z_y - a * z_x, 3, a, var_zy_given_zx)
+        self.cross_cov = True
+
+    def _scalar_update(self, z, i, a, var_z):
+        # in-place update with the scalar measurement
+        # z = x[i] - a * x[0] + noise of variance var_z
+        x = self.state
+        P = self.state_cov
+        SigmaH = self._sigma_h
+        k = self._k
+        numpy.multiply(P[:, 0], a, out = k)
+        numpy.subtract(P[:, i], k, out = SigmaH)
+        s = SigmaH[i] - a * SigmaH[0] + var_z
+        numpy.divide(SigmaH, s, out = k)
+        innovation = z - x[i, 0] + a * x[0, 0]
+        numpy.matmul(self._k_column, self._sigma_h_row, out = self._work)
+        numpy.subtract(P, self._work, out = P)
+        numpy.multiply(k, innovation, out = SigmaH)
+        numpy.add(x[:, 0], SigmaH, out = x[:, 0])
+
+    def _measure_decoupled(self, z_x, z_y, var_zx, var_zy):
+        # with no cross-covariance and uncorrelated noise the innovation
+        # covariance is diagonal, so each gain column is a column of
+        # Sigma C^T over its own innovation variance and both components
+        # go in at once, without decorrelating them first
+        P = self.predicted_state_cov
+        x = self.predicted_state
+        k = self.gain
+        numpy.divide(P[:, 0], P[0, 0] + var_zx, out = k[:, 0])
+        numpy.divide(P[:, 3], P[3, 3] + var_zy, out = k[:, 1])
+        self._innovation[0, 0] = z_x - x[0, 0]
+        self._innovation[1, 0] = z_y - x[3, 0]
+        numpy.matmul(k, self._innovation, out = self.state)
+        numpy.add(self.state, x, out = self.state)
+        numpy.copyto(self._cov_rows, self._predicted_cov_rows)
+        numpy.matmul(k, self._cov_rows, out = self._work)
+        numpy.subtract(P, self._work, out = self.state_cov)
+
+    def _steady_state_key(self, delta_t, var_vx, var_vy,
+                          var_zx, var_zy, rho_zxy):
+        return (round(delta_t / cache_time_resolution),
+                var_vx, var_vy, var_zx, var_zy, rho_zxy) + \
+                self._motor_params()
+
+    def _advance_steady_state(self, timestamp, v_x, v_y, z_x, z_y):
+        delta_t = timestamp - self.time
+        self.time = timestamp
+        A, _, g = self._transition(delta_t)
+        x = self.predicted_state
+        numpy.matmul(A, self.state, out = x)
+        x[2, 0] += g * v_x
+        x[5, 0] += g * v_y
+        self._innovation[0, 0] = z_x - x[0, 0]
+        self._innovation[1, 0] = z_y - x[3, 0]
+        numpy.matmul(self._ss_gain, self._innovation, out = self.state)
+        numpy.add(self.state, x, out = self.state)
+
+    def _test_steady_state(self, var_zx, var_zy, rho_zxy):
+        # compares the posterior covariance with the one of the previous
+        # step; the gain is only formed once the two agree
+        W = self._work
+        numpy.subtract(self.state_cov, self._prior_state_cov, out = W)
+        numpy.abs(W, out = W)
+        change = W.max()
+        numpy.abs(self.state_cov, out = W)
+        if change > steady_state_tol * W.max():
+            return
+        # K = Sigma C^T (C Sigma C^T + sigma_z)^-1 for the predicted
+        # Sigma, which unlike the posterior form needs no inverse of
+        # sigma_z and so also holds for an exact fix
+        cov_zxy = rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy)
+        sigma_z = numpy.array([[var_zx, cov_zxy],
+                               [cov_zxy, var_zy]])
+        CSigma = self.predicted_state_cov[(0, 3), :]
+        numpy.copyto(self.gain, numpy.linalg.solve(
+            CSigma[:, (0, 3)] + sigma_z, CSigma).transpose())
+        self._ss_gain = self.gain.copy()
+
+    def solve_steady_state(self, delta_t = default_time_step,
+                           var_vx = default_var, var_vy = default_var,
+                           var_zx = default_var, var_zy = default_var,
+                           rho_zxy = 0):
+        # solve the discrete algebraic Riccati equation for the predicted
+        # covariance and install the resulting gain, so the filter starts
+        # out in steady state instead of converging online (which, with
+        # the weakly observable motor current, can take thousands of steps)
+        _, AT, g = self._transition(delta_t)
+        Q = numpy.zeros((6, 6))
+        Q[2, 2] = g * g * var_vx
+        Q[5, 5] = g * g * var_vy
+        cov_zxy = rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy)
+        sigma_z = numpy.array([[var_zx, cov_zxy],
+                               [cov_zxy, var_zy]])
+        predicted_state_cov = scipy.linalg.solve_discrete_are(
+            AT, self.CT, Q, sigma_z)
+        SigmaXCT = predicted_state_cov @ self.CT
+        K = SigmaXCT @ numpy.linalg.inv(self.C @ SigmaXCT + sigma_z)
+        numpy.copyto(self.state_cov, (numpy.identity(6) - K @ self.C) @
+                     predicted_state_cov)
+        numpy.copyto(self.predicted_state_cov, predicted_state_cov)
+        numpy.copyto(self.gain, K)
+        self.cross_cov = True
+        self._ss_key = self._steady_state_key(delta_t, var_vx, var_vy,
+                                              var_zx, var_zy, rho_zxy)
+        self._ss_gain = K
+
+    def advance_filter(self, timestamp, v_x, v_y, z_x, z_y,
+                       var_vx = default_var, var_vy = default_var,
+                       var_zx = default_var, var_zy = default_var,
+                       rho_zxy = 0):
+        if not self.steady_state:
+            self._predict(timestamp, v_x, v_y, var_vx, var_vy)
+            self._measure(z_x, z_y, var_zx, var_zy, rho_zxy)
+            return
+        if self.time is None:
+            raise RuntimeError('uninitialized filter')
+        key = self._steady_state_key(timestamp - self.time, var_vx, var_vy,
+                                     var_zx, var_zy, rho_zxy)
+        if self._ss_gain is not None and key == self._ss_key:
+            self._advance_steady_state(timestamp, v_x, v_y, z_x, z_y)
+            return
+        if key != self._ss_key:
+            self._ss_key = key
+            self._ss_gain = None
+            self._ss_steps = 0
+        # convergence is only tested every few steps, which keeps the
+        # cost of the mode close to the plain filter until it freezes
+        self._ss_steps += 1
+        check = self._ss_steps % steady_state_check_interval == 0
+        if check:
+            numpy.copyto(self._prior_state_cov, self.state_cov)
+        self._predict(timestamp, v_x, v_y, var_vx, var_vy)
+        self._measure(z_x, z_y, var_zx, var_zy, rho_zxy)
+        if check:
+            self._test_steady_state(var_zx, var_zy, rho_zxy)
+
+    def simulate_system(self, timestamp, v_x, v_y):
+        self._predict(timestamp, v_x, v_y)
+        self._skip_measure()
+
+    def advance_prediction(self, timestamp, v_x, v_y,
+                           var_vx = default_var, var_vy = default_var):
+        # time update only, for stretches with no measurement; unlike
+        # simulate_system() the predicted covariance is kept
+        self._predict(timestamp, v_x, v_y, var_vx, var_vy)
+        numpy.copyto(self.state, self.predicted_state)
+        numpy.copyto(self.state_cov, self.predicted_state_cov)
+        self._ss_key = None
+        self._ss_gain = None
+
+    def checkpoint(self):
+        return (self.time, self.state.copy(), self.state_cov.copy(),
+                self.cross_cov)
+
+    def restore(self, checkpoint):
+        self.time, state, state_cov, self.cross_cov = checkpoint
+        numpy.copyto(self.state, state)
+        numpy.copyto(self.state_cov, state_cov)
+        self._ss_key = None
+        self._ss_gain = None
+
+    def _trajectory_powers(self, delta_t, m):
+        # for a uniform time step, x[s + j] = A^j x[s] + G[j] u[s+1..s+m],
+        # where G holds the A^(j-l) B blocks of the input response
+        params = self._check_cache_params()
+        key = (round(delta_t / cache_time_resolution), m) + params
+        entry = self._power_cache.get(key)
+        if entry is not None:
+            self.cache_hits += 1
+            self._power_cache.move_to_end(key)
+            return entry
+        self.cache_misses += 1
+        A = self.A_matrix(delta_t)
+        B = self.B_matrix(delta_t)
+        powers = numpy.empty((m + 1, 6, 6))
+        powers[0] = numpy.identity(6)
+        for j in range(1, m + 1):
+            powers[j] = A @ powers[j - 1]
+        response = numpy.zeros((m, 6, m, 2))
+        for j in range(m):
+            for l in range(j + 1):
+                response[j, :, l, :] = powers[j - l] @ B
+        entry = (powers[1:], response.reshape(m * 6, m * 2))
+        self._power_cache[key] = entry
+        if len(self._power_cache) > self.cache_size:
+            self._power_cache.popitem(last = False)
+        return entry
+
+    def simulate_trajectory(self, timestamps, v_x, v_y):
+        # noise-free equivalent of calling simulate_system() for every
+        # element of timestamps, returning the (len(timestamps), 6) array
+        # of states visited; v_x[i], v_y[i] drive the step ending at
+        # timestamps[i], exactly as in simulate_system()
+        if self.time is None:
+            raise RuntimeError('uninitialized filter')
+        timestamps = numpy.asarray(timestamps, dtype = float)
+        u = numpy.stack([numpy.broadcast_to(v_x, timestamps.shape),
+                         numpy.broadcast_to(v_y, timestamps.shape)], axis = -1)
+        T = len(timestamps)
+        states = numpy.empty((T, 6))
+        if T == 0:
+            return states
+        delta_t = numpy.diff(timestamps, prepend = self.time)
+        if numpy.all(numpy.abs(delta_t - delta_t[0]) < cache_time_resolution):
+            self._simulate_uniform(delta_t[0], u, states)
+        else:
+            self._simulate_nonuniform(delta_t, u, states)
+        self.time = timestamps[-1]
+        self.state[:, 0] = states[-1]
+        self._reset_state_cov()
+        return states
+
+    def _simulate_uniform(self, delta_t, u, states):
+        T = len(u)
+        m = min(T, trajectory_block_size)
+        num_blocks = -(-T // m)
+        powers, response = self._trajectory_powers(delta_t, m)
+        padded_u = numpy.zeros((num_blocks * m, 2))
+        padded_u[:T] = u
+        # response of every block to its own inputs, all in one product
+        local = (padded_u.reshape(num_blocks, m * 2) @
+                 response.transpose()).reshape(num_blocks, m, 6)
+        # chain the block start states; only this part is sequential
+        starts = numpy.empty((num_blocks, 6))
+        starts[0] = self.state[:, 0]
+        Am = powers[-1]
+        for i in range(1, num_blocks):
+            starts[i] = Am @ starts[i - 1] + local[i - 1, -1]
+        local += numpy.einsum('jkl,bl->bjk', powers, starts)
+        states[:] = local.reshape(num_blocks * m, 6)[:T]
+
+    def _simulate_nonuniform(self, delta_t, u, states):
+        A = self.A_matrices(delta_t)
+        Bu = numpy.zeros((len(delta_t), 6))
+        Bu[:, 2] = delta_t / self.L * u[:, 0]
+        Bu[:, 5] = delta_t / self.L * u[:, 1]
+        x = self.state[:, 0]
+        for i in range(len(delta_t)):
+            x = A[i] @ x + Bu[i]
+            states[i] = x
+
+    def get_estimate(self):
+        z = self.C @ self.state
+        z_cov = self.C @ self.state_cov @ self.CT
+        return z, z_cov
+
+    def get_state(self):
+        # the filter keeps updating its buffers in place, so hand out
+        # copies rather than views that would change under the caller
+        return self.state.copy(), self.state_cov.copy()
+
+class CartesianBotKFBank:
+    def __init__(self, num_filters, torque_const, rotor_inertia,
+                 friction_const, armature_res, armature_ind, wheel_radius):
+        self.N = num_filters
+        self.K = torque_const
+        self.J = rotor_inertia
+        self.b = friction_const
+        self.R = armature_res
+        self.L = armature_ind
+        self.r = wheel_radius
+        self.state = numpy.zeros((self.N, 6, 1))
+        self.state_cov = numpy.tile(numpy.identity(6) * default_var,
+                                    (self.N, 1, 1))
+        self.predicted_state = numpy.zeros((self.N, 6, 1))
+        self.predicted_state_cov = self.state_cov.copy()
+        self.time = None
+
+    def _per_filter(self, value):
+        # scalars apply to every filter, arrays carry one value per filter
+        return numpy.broadcast_to(
+            numpy.asarray(value, dtype=float), (self.N,))
+
+    def set_state(self, timestamp,
+                  position_x = 0, position_y = 0,
+                  wheel_ang_vel_x = 0, wheel_ang_vel_y = 0,
+                  motor_current_x = 0, motor_current_y = 0):
+        self.time = self._per_filter(timestamp).copy()
+        self.state[:, 0, 0] = self._per_filter(position_x)
+        self.state[:, 1, 0] = self._per_filter(wheel_ang_vel_x)
+        self.state[:, 2, 0] = self._per_filter(motor_current_x)
+        self.state[:, 3, 0] = self._per_filter(position_y)
+        self.state[:, 4, 0] = self._per_filter(wheel_ang_vel_y)
+        self.state[:, 5, 0] = self._per_filter(motor_current_y)
+        self.state_cov[:] = numpy.identity(6) * default_var
+
+    def A_matrix(self, delta_t = default_time_step):
+        delta_t = self._per_filter(delta_t)
+        A = numpy.tile(numpy.identity(6), (self.N, 1, 1))
+        A[:, 0, 1] = A[:, 3, 4] = self.r * delta_t
+        A[:, 1, 1] = A[:, 4, 4] = 1 - delta_t * self.b / self.J
+        A[:, 1, 2] = A[:, 4, 5] = delta_t * self.K / self.J
+        A[:, 2, 1] = A[:, 5, 4] = -delta_t * self.K / self.L
+        A[:, 2, 2] = A[:, 5, 5] = 1 - delta_t * self.R / self.L
+        return A
+
+    def B_matrix(self, delta_t = default_time_step):
+        delta_t = self._per_filter(delta_t)
+        B = numpy.zeros((self.N, 6, 2))
+        B[:, 2, 0] = B[:, 5, 1] = delta_t / self.L
+        return B
+
+    def C_matrix(self):
+        C = numpy.zeros((2,6))
+        C[0, 0] = 1
+        C[1, 3] = 1
+        return C
+
+    def _predict(self, timestamp, v_x, v_y,
+                 var_vx = default_var, var_vy = default_var):
+        if self.time is None:
+            raise RuntimeError('uninitialized filter')
+        timestamp = self._per_filter(timestamp)
+        delta_t = timestamp - self.time
+        self.time = timestamp.copy()
+        u = numpy.stack([self._per_filter(v_x),
+                         self._per_filter(v_y)], axis=-1)[:, :, None]
+        sigma_u = numpy.zeros((self.N, 2, 2))
+        sigma_u[:, 0, 0] = self._per_filter(var_vx)
+        sigma_u[:, 1, 1] = self._per_filter(var_vy)
+        A = self.A_matrix(delta_t)
+        B = self.B_matrix(delta_t)
+        self.predicted_state = A @ self.state + B @ u
+        self.predicted_state_cov = \
+            A @ self.state_cov @ A.transpose(0, 2, 1) + \
+            B @ sigma_u @ B.transpose(0, 2, 1)
+
+    def _skip_measure(self):
+        self.state = self.predicted_state
+        self.state_cov = numpy.tile(numpy.identity(6) * default_var,
+                                    (self.N, 1, 1))
+
+    def peek_pos(self):
+        return self.state[:, 0, 0], self.state[:, 3, 0]
+
+    def peek_omega(self):
+        return self.state[:, 1, 0], self.state[:, 4, 0]
+
+    def peek_current(self):
+        return self.state[:, 2, 0], self.state[:, 5, 0]
+
+    def _measure(self, z_x, z_y,
+                 var_zx = default_var, var_zy = default_var,
+                 rho_zxy = 0):
+        var_zx = self._per_filter(var_zx)
+        var_zy = self._per_filter(var_zy)
+        cov_zxy = self._per_filter(rho_zxy) * \
+            numpy.sqrt(var_zx) * numpy.sqrt(var_zy)
+        sigma_z = numpy.empty((self.N, 2, 2))
+        sigma_z[:, 0, 0] = var_zx
+        sigma_z[:, 0, 1] = sigma_z[:, 1, 0] = cov_zxy
+        sigma_z[:, 1, 1] = var_zy
+        z = numpy.stack([self._per_filter(z_x),
+                         self._per_filter(z_y)], axis=-1)[:, :, None]
+        C = self.C_matrix()
+        # the covariance is symmetric, so C Sigma is (Sigma C^T)^T and the
+        # gain can be had from a batched solve instead of an inverse
+        CSigmaX = C @ self.predicted_state_cov
+        CSigmaXCT = CSigmaX @ C.transpose()
+        K = numpy.linalg.solve(CSigmaXCT + sigma_z,
+                               CSigmaX).transpose(0, 2, 1)
         self.state = self.predicted_state + K @ \
-            (z - self.C_matrix() @ self.predicted_state)
-        self.state_cov = (numpy.identity(6) - K @ self.C_matrix()) @ \
+            (z - C @ self.predicted_state)
+        self.state_cov = (numpy.identity(6) - K @ C) @ \
             self.predicted_state_cov
 
     def advance_filter(self, timestamp, v_x, v_y, z_x, z_y,
@@ -113,8 +601,9 @@ class CartesianBotKF:
         self._skip_measure()
 
     def get_estimate(self):
-        z = self.C_matrix() @ self.state
-        z_cov = self.C_matrix() @ self.state_cov @ self.C_matrix().transpose()
+        C = self.C_matrix()
+        z = C @ self.state
+        z_cov = C @ self.state_cov @ C.transpose()
         return z, z_cov
 
     def get_state(self):
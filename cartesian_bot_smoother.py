@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import numpy
+from cartesian_bot_kf import default_var
+
+def rts_backward(A, filtered_state, filtered_state_cov,
+                 predicted_state, predicted_state_cov):
+    # Rauch-Tung-Striebel backward pass over n chronological steps.
+    # A[k] takes step k - 1 to step k (A[0] is unused), predicted_* hold
+    # the one-step predictions into each step and filtered_* the
+    # posteriors after its measurement
+    n = len(filtered_state)
+    smoothed_state = filtered_state.copy()
+    smoothed_state_cov = filtered_state_cov.copy()
+    if n < 2:
+        return smoothed_state, smoothed_state_cov
+    # all smoother gains G[k] = P[k] A[k+1]^T P-[k+1]^-1 in one batched
+    # solve (covariances are symmetric, so G^T = P-^-1 A P)
+    G = numpy.linalg.solve(predicted_state_cov[1:],
+                           A[1:] @ filtered_state_cov[:-1]).transpose(0, 2, 1)
+    GT = G.transpose(0, 2, 1)
+    for k in range(n - 2, -1, -1):
+        smoothed_state[k] += G[k] @ \
+            (smoothed_state[k + 1] - predicted_state[k + 1])
+        smoothed_state_cov[k] += G[k] @ \
+            (smoothed_state_cov[k + 1] - predicted_state_cov[k + 1]) @ GT[k]
+    return smoothed_state, smoothed_state_cov
+
+class CartesianBotRTSSmoother:
+    def __init__(self, estimator, num_steps):
+        # wraps a CartesianBotKF, recording only what the backward pass
+        # needs; the A matrices are rebuilt from the stored time steps
+        self.estimator = estimator
+        self.num_steps = num_steps
+        self.count = 0
+        self.time = numpy.empty(num_steps)
+        self.delta_t = numpy.empty(num_steps)
+        self.filtered_state = numpy.empty((num_steps, 6))
+        self.filtered_state_cov = numpy.empty((num_steps, 6, 6))
+        self.predicted_state = numpy.empty((num_steps, 6))
+        self.predicted_state_cov = numpy.empty((num_steps, 6, 6))
+
+    def advance_filter(self, timestamp, v_x, v_y, z_x, z_y,
+                       var_vx = default_var, var_vy = default_var,
+                       var_zx = default_var, var_zy = default_var,
+                       rho_zxy = 0):
+        if self.count == self.num_steps:
+            raise RuntimeError('smoother capacity exceeded')
+        if self.estimator.time is None:
+            raise RuntimeError('uninitialized filter')
+        k = self.count
+        self.delta_t[k] = timestamp - self.estimator.time
+        self.estimator.advance_filter(timestamp, v_x, v_y, z_x, z_y,
+                                      var_vx, var_vy, var_zx, var_zy,
+                                      rho_zxy)
+        self.time[k] = timestamp
+        self.filtered_state[k] = self.estimator.state[:, 0]
+        self.filtered_state_cov[k] = self.estimator.state_cov
+        self.predicted_state[k] = self.estimator.predicted_state[:, 0]
+        self.predicted_state_cov[k] = self.estimator.predicted_state_cov
+        self.count += 1
+
+    def smooth(self):
+        n = self.count
+        return rts_backward(self.estimator.A_matrices(self.delta_t[:n]),
+                            self.filtered_state[:n],
+                            self.filtered_state_cov[:n],
+                            self.predicted_state[:n],
+                            self.predicted_state_cov[:n])
+
+class CartesianBotFixedLagSmoother:
+    def __init__(self, estimator, lag):
+        # keeps the last lag + 1 steps in a ring buffer; once it is full
+        # every new step yields the smoothed estimate from lag steps ago
+        self.estimator = estimator
+        self.lag = lag
+        size = lag + 1
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.time = numpy.empty(size)
+        self.delta_t = numpy.empty(size)
+        self.filtered_state = numpy.empty((size, 6))
+        self.filtered_state_cov = numpy.empty((size, 6, 6))
+        self.predicted_state = numpy.empty((size, 6))
+        self.predicted_state_cov = numpy.empty((size, 6, 6))
+
+    def _window(self):
+        order = (self.head + numpy.arange(self.count)) % self.size
+        smoothed_state, smoothed_state_cov = rts_backward(
+            self.estimator.A_matrices(self.delta_t[order]),
+            self.filtered_state[order], self.filtered_state_cov[order],
+            self.predicted_state[order], self.predicted_state_cov[order])
+        return self.time[order], smoothed_state, smoothed_state_cov
+
+    def advance_filter(self, timestamp, v_x, v_y, z_x, z_y,
+                       var_vx = default_var, var_vy = default_var,
+                       var_zx = default_var, var_zy = default_var,
+                       rho_zxy = 0):
+        if self.estimator.time is None:
+            raise RuntimeError('uninitialized filter')
+        if self.count == self.size:
+            # drop the oldest step, it has already been reported
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+        k = (self.head + self.count) % self.size
+        self.delta_t[k] = timestamp - self.estimator.time
+        self.estimator.advance_filter(timestamp, v_x, v_y, z_x, z_y,
+                                      var_vx, var_vy, var_zx, var_zy,
+                                      rho_zxy)
+        self.time[k] = timestamp
+        self.filtered_state[k] = self.estimator.state[:, 0]
+        self.filtered_state_cov[k] = self.estimator.state_cov
+        self.predicted_state[k] = self.estimator.predicted_state[:, 0]
+        self.predicted_state_cov[k] = self.estimator.predicted_state_cov
+        self.count += 1
+        if self.count < self.size:
+            return None
+        t, smoothed_state, smoothed_state_cov = self._window()
+        return t[0], smoothed_state[0], smoothed_state_cov[0]
+
+    def flush(self):
+        # smoothed estimates for the steps still in the buffer, i.e. the
+        # ones not yet reported by advance_filter()
+        t, smoothed_state, smoothed_state_cov = self._window()
+        start = 1 if self.count == self.size else 0
+        return t[start:], smoothed_state[start:], smoothed_state_cov[start:]
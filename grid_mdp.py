@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+from value_iteration import directions, load_terminal_states, terminal_grid
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+# bump when the layout of cached models changes
+cache_version = 1
+
+# policy grid symbols, in directions order, then terminal, walled-in
+# (absorbing) and obstacle cells
+direction_symbols = [ 'L', 'R', 'T', 'B' ]
+terminal_symbol = '*'
+absorbing_symbol = 'o'
+obstacle_symbol = '#'
+
+solver_names = [ 'vi', 'pi', 'mpi' ]
+# iteration cap of the solvers: sweeps for value iteration, improvement
+# steps for (modified) policy iteration
+default_max_iterations = 100000
+
+class GridMDP:
+    def __init__(self, state_index, transitions, invalid,
+                 terminal, terminal_values):
+        # state_index maps grid cells to state numbers (-1 for obstacles);
+        # transitions stacks the per-action transition matrices into one
+        # (4 S, S) CSR matrix, rows a * S to (a + 1) * S - 1 being action
+        # a (in directions order); invalid is (4, S), -inf where an action
+        # leads off the grid or into an obstacle, 0 elsewhere. Terminal
+        # states have no transitions and keep their value. So do free
+        # cells walled in by obstacles, which have no valid action: they
+        # are absorbing, with value 0 unless they are terminal.
+        self.state_index = state_index
+        self.shape = state_index.shape
+        self.num_states = int(transitions.shape[1])
+        self.transitions = transitions
+        self.invalid = invalid
+        cells = state_index >= 0
+        self.terminal = terminal[cells]
+        self.absorbing = np.all(np.isneginf(invalid), axis = 0)
+        self.fixed = self.terminal | self.absorbing
+        self.fixed_values = np.where(terminal[cells], terminal_values[cells], 0)
+
+    def action_matrix(self, action):
+        s = self.num_states
+        return self.transitions[action * s:(action + 1) * s]
+
+    def init_values(self):
+        return self.fixed_values.copy()
+
+    def control_values(self, values):
+        # (4, S) expected next-state value of every action, -inf where
+        # the action is not available
+        q = (self.transitions @ values).reshape(len(directions), -1)
+        q += self.invalid
+        return q
+
+    def backup(self, values, gamma, movecost):
+        best = self.control_values(values).max(axis = 0)
+        best -= movecost
+        best *= gamma
+        return np.where(self.fixed, self.fixed_values, best)
+
+    def to_grid(self, values):
+        # state vector to an (X, Y) grid, NaN on obstacles
+        grid = np.full(self.shape, np.nan)
+        grid[self.state_index >= 0] = values
+        return grid
+
+    def greedy_policy(self, values, policy = None):
+        # best action of every state; where a current policy is given its
+        # action is kept unless another one is strictly better, so that
+        # ties cannot make policy iteration cycle
+        q = self.control_values(values)
+        best = q.argmax(axis = 0)
+        if policy is not None:
+            states = np.arange(self.num_states)
+            keep = q[policy, states] >= q[best, states] - \
+                1e-12 * np.abs(q[best, states])
+            best = np.where(keep, policy, best)
+        return best
+
+    def policy_matrix(self, policy):
+        # (S, S) transitions under a fixed action per state
+        return self.transitions[policy * self.num_states +
+                                np.arange(self.num_states)]
+
+    def evaluate_policy(self, policy, gamma, movecost):
+        # exact policy values from the sparse linear system
+        # (I - gamma P) V = -gamma * movecost, where terminal rows of P are
+        # empty and their right-hand side is the terminal value
+        a = scipy.sparse.identity(self.num_states, format = 'csr') - \
+            gamma * self.policy_matrix(policy)
+        b = np.where(self.fixed, self.fixed_values, -gamma * movecost)
+        return scipy.sparse.linalg.spsolve(a.tocsc(), b)
+
+    def policy_grid(self, policy):
+        grid = np.full(self.shape, obstacle_symbol)
+        symbols = np.array(direction_symbols)[policy]
+        symbols[self.absorbing] = absorbing_symbol
+        symbols[self.terminal] = terminal_symbol
+        grid[self.state_index >= 0] = symbols
+        return grid
+
+def compile_grid_mdp(obstacles, terminal, probslip):
+    # the value_iteration.py motion model on a grid with obstacles: the
+    # robot reaches the neighbor it aims for with probability
+    # 1 - (n - 1) * p and slips to each of its other n - 1 neighbors with
+    # probability p, where obstacles count as missing neighbors
+    xgrid, ygrid = obstacles.shape
+    cells = ~obstacles
+    state_index = np.full(obstacles.shape, -1)
+    state_index[cells] = np.arange(cells.sum())
+    num_states = int(cells.sum())
+    x, y = np.nonzero(cells)
+    neighbors = []
+    for dx, dy in directions:
+        nx = x + dx
+        ny = y + dy
+        inside = (nx >= 0) & (nx < xgrid) & (ny >= 0) & (ny < ygrid)
+        neighbor = np.full(num_states, -1)
+        neighbor[inside] = state_index[nx[inside], ny[inside]]
+        neighbors.append(neighbor)
+    neighbors = np.array(neighbors)
+    valid = neighbors >= 0
+    num_neighbors = valid.sum(axis = 0)
+    moving = ~terminal[cells]
+    rows = []
+    columns = []
+    probabilities = []
+    for a in range(len(directions)):
+        for j in range(len(directions)):
+            source = np.flatnonzero(valid[a] & valid[j] & moving)
+            rows.append(a * num_states + source)
+            columns.append(neighbors[j, source])
+            if j == a:
+                probabilities.append(1 - (num_neighbors[source] - 1) * probslip)
+            else:
+                probabilities.append(np.full(len(source), probslip))
+    transitions = scipy.sparse.csr_matrix(
+        (np.concatenate(probabilities),
+         (np.concatenate(rows), np.concatenate(columns))),
+        shape = (len(directions) * num_states, num_states))
+    invalid = np.where(valid, 0, -np.inf)
+    return state_index, transitions, invalid
+
+def model_key(obstacles, terminal, probslip):
+    h = hashlib.sha1()
+    h.update(json.dumps([ cache_version, obstacles.shape, probslip ]).encode())
+    h.update(np.packbits(obstacles).tobytes())
+    h.update(np.packbits(terminal).tobytes())
+    return h.hexdigest()
+
+def load_grid_mdp(obstacles, terminal, terminal_values, probslip,
+                  cache_dir = None):
+    # compiled models depend only on the obstacles, the terminal cells and
+    # the slip probability, so they are cached under a hash of those
+    obstacles = np.asarray(obstacles, dtype = bool)
+    terminal = np.asarray(terminal, dtype = bool)
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, model_key(obstacles, terminal,
+                                                 probslip) + '.npz')
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                transitions = scipy.sparse.csr_matrix(
+                    (cached['data'], cached['indices'], cached['indptr']),
+                    shape = tuple(cached['shape']))
+                return GridMDP(cached['state_index'], transitions,
+                               cached['invalid'], terminal, terminal_values)
+    state_index, transitions, invalid = compile_grid_mdp(
+        obstacles, terminal, probslip)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        # write then rename so a concurrent reader never sees half a file
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, state_index = state_index, data = transitions.data,
+                     indices = transitions.indices,
+                     indptr = transitions.indptr,
+                     shape = np.array(transitions.shape), invalid = invalid)
+        os.replace(path + '.tmp', path)
+    return GridMDP(state_index, transitions, invalid, terminal,
+                   terminal_values)
+
+def load_terminals(path, xgrid, ygrid):
+    # a value_iteration.py style JSON list, or an .npy grid of terminal
+    # values that is NaN on non-terminal cells
+    if path.endswith('.npy'):
+        values = np.load(path)
+        terminal = ~np.isnan(values)
+        return terminal, np.where(terminal, values, 0)
+    values, terminal = terminal_grid(load_terminal_states(path),
+                                     xgrid, ygrid)
+    return terminal, values
+
+def load_obstacles(path, xgrid, ygrid):
+    # an .npy boolean grid, or a JSON list of {"x": ..., "y": ...} cells
+    obstacles = np.zeros((xgrid, ygrid), dtype = bool)
+    if path is None:
+        return obstacles
+    if path.endswith('.npy'):
+        return np.load(path).astype(bool)
+    with open(path) as f:
+        for cell in json.load(f):
+            obstacles[cell['x'], cell['y']] = True
+    return obstacles
+
+def value_iteration(mdp, gamma, movecost, epsilon,
+                    max_iterations = default_max_iterations):
+    values = mdp.init_values()
+    iterations = 0
+    delta = float('inf')
+    while delta > epsilon and \
+          (max_iterations is None or iterations < max_iterations):
+        new_values = mdp.backup(values, gamma, movecost)
+        delta = np.max(np.abs(new_values - values))
+        # a NaN delta would compare as converged
+        if not np.isfinite(delta):
+            raise RuntimeError('value iteration produced non-finite values')
+        values = new_values
+        iterations += 1
+    return values, iterations
+
+def policy_iteration(mdp, gamma, movecost,
+                     max_iterations = default_max_iterations):
+    # alternate exact evaluation and greedy improvement until the policy
+    # stops changing; returns values, policy and the number of
+    # evaluations (linear solves)
+    policy = mdp.greedy_policy(mdp.init_values())
+    iterations = 0
+    while max_iterations is None or iterations < max_iterations:
+        values = mdp.evaluate_policy(policy, gamma, movecost)
+        if not np.all(np.isfinite(values)):
+            raise RuntimeError('policy evaluation produced non-finite values')
+        iterations += 1
+        new_policy = mdp.greedy_policy(values, policy)
+        if np.array_equal(new_policy, policy):
+            break
+        policy = new_policy
+    return values, policy, iterations
+
+def modified_policy_iteration(mdp, gamma, movecost, epsilon, sweeps,
+                              max_iterations = default_max_iterations):
+    # greedy improvement followed by a partial evaluation of the policy
+    # with a number of sweeps of its backup, until the Bellman backup
+    # moves the values by no more than epsilon; returns values, policy,
+    # the number of improvements and the total sweeps (improvements
+    # included, as each one is a full backup)
+    values = mdp.init_values()
+    policy = None
+    iterations = 0
+    total_sweeps = 0
+    while max_iterations is None or iterations < max_iterations:
+        backed_up = mdp.backup(values, gamma, movecost)
+        policy = mdp.greedy_policy(values, policy)
+        iterations += 1
+        total_sweeps += 1
+        residual = np.max(np.abs(backed_up - values))
+        # a NaN residual would never pass the test below
+        if not np.isfinite(residual):
+            raise RuntimeError('modified policy iteration produced '
+                               'non-finite values')
+        if residual <= epsilon:
+            values = backed_up
+            break
+        values = backed_up
+        p = mdp.policy_matrix(policy)
+        for _ in range(sweeps):
+            values = np.where(mdp.fixed, mdp.fixed_values,
+                              gamma * (p @ values - movecost))
+        total_sweeps += sweeps
+    return values, policy, iterations, total_sweeps
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Value iteration, policy iteration and modified policy '
+        'iteration on the value_iteration.py grid model, compiled once into '
+        'sparse per-action transition matrices. Prints the value and greedy '
+        'policy grids. Supports obstacle maps and terminal sets given as '
+        'value grids, and caches compiled models on disk.')
+    parser.add_argument('--gamma', '-g', type=float, default = 0.9,
+                        help='discount factor gamma')
+    parser.add_argument('--xgrid', '-x', type=int, default = 4,
+                        help='grid size in x-dimension')
+    parser.add_argument('--ygrid', '-y', type=int, default = 4,
+                        help='grid size in y-dimension')
+    parser.add_argument('--probslip', '-p', type=float, default = 0.1,
+                        help='slip/skid probability')
+    parser.add_argument('--movecost', '-m', type=float, default = 1,
+                        help='cost of moving')
+    parser.add_argument('--epsilon', '-e', type=float, default = 1e-3,
+                        help='epsilon for convergence criteria')
+    parser.add_argument('--termstates', '-t', type=str,
+                        default = 'terminal_states.json',
+                        help = 'terminal states: JSON list of x, y, value '
+                        'or .npy value grid with NaN on non-terminal cells')
+    parser.add_argument('--obstacles', '-o', type=str, default = None,
+                        help='obstacles: JSON list of x, y or .npy boolean '
+                        'grid')
+    parser.add_argument('--cache', type=str, default = 'grid_mdp_cache',
+                        help='directory for compiled models ("" disables)')
+    parser.add_argument('--solver', type=str, nargs='+', choices=solver_names,
+                        default = [ 'vi' ],
+                        help='value iteration, policy iteration and/or '
+                        'modified policy iteration; several are compared '
+                        'side by side')
+    parser.add_argument('--sweeps', '-k', type=int, default = 10,
+                        help='partial evaluation sweeps per modified policy '
+                        'iteration step')
+    parser.add_argument('--maxiter', type=int,
+                        default = default_max_iterations,
+                        help='iteration cap of every solver')
+    args = parser.parse_args()
+
+    terminal, terminal_values = load_terminals(args.termstates,
+                                               args.xgrid, args.ygrid)
+    xgrid, ygrid = terminal.shape
+    obstacles = load_obstacles(args.obstacles, xgrid, ygrid)
+    start = time.time()
+    mdp = load_grid_mdp(obstacles, terminal, terminal_values, args.probslip,
+                        args.cache or None)
+    build_time = time.time() - start
+    print('{} states, model {:.3f} s'.format(mdp.num_states, build_time))
+    results = []
+    for solver in args.solver:
+        start = time.time()
+        if solver == 'vi':
+            values, iterations = value_iteration(
+                mdp, args.gamma, args.movecost, args.epsilon, args.maxiter)
+            policy = mdp.greedy_policy(values)
+            work = '{} sweeps'.format(iterations)
+        elif solver == 'pi':
+            values, policy, iterations = policy_iteration(
+                mdp, args.gamma, args.movecost, args.maxiter)
+            work = '{} solves'.format(iterations)
+        else:
+            values, policy, iterations, sweeps = modified_policy_iteration(
+                mdp, args.gamma, args.movecost, args.epsilon, args.sweeps,
+                args.maxiter)
+            work = '{} sweeps'.format(sweeps)
+        results.append((solver, values, policy, iterations, work,
+                        time.time() - start))
+        if iterations >= args.maxiter:
+            print('{} stopped at --maxiter {} before converging'.format(
+                solver, args.maxiter))
+
+    solver, values, policy = results[0][:3]
+    print('values ({})'.format(solver))
+    print(np.round(mdp.to_grid(values), 2))
+    print('policy ({})'.format(solver))
+    for row in mdp.policy_grid(policy):
+        print(' '.join(row))
+    print('{:>6} {:>10} {:>14} {:>10} {:>14}'.format(
+        'solver', 'iterations', 'work', 'time (s)', 'max value diff'))
+    for solver, v, _, iterations, work, elapsed in results:
+        print('{:>6} {:>10} {:>14} {:>10.3f} {:>14.2e}'.format(
+            solver, iterations, work, elapsed, np.max(np.abs(v - values))))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+from cartesian_bot_kf import CartesianBotKF
+from simulate_cartesian_bot_and_kf_estimator import \
+    K, J, b, R, L, r, generate_measurement
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import chi2
+import argparse
+import functools
+import math
+import os
+import time
+import numpy
+
+def run_trial(seed, num_steps, t_step, vx_variance, vy_variance):
+    # one independent trial: simulate the bot driven by noisy voltages,
+    # filter with the nominal voltages and return per-step NEES (full
+    # state), NIS (position measurement) and squared position error
+    rng = numpy.random.default_rng(seed)
+    all_t = numpy.arange(1, num_steps + 1) * t_step
+    vx_nominal = numpy.where(all_t < 4, 10, 0)
+    vy_nominal = numpy.where((all_t < 7) & (all_t > 2), 5, 0)
+    vx = vx_nominal + rng.normal(0, math.sqrt(vx_variance), num_steps)
+    vy = vy_nominal + rng.normal(0, math.sqrt(vy_variance), num_steps)
+
+    bot_model = CartesianBotKF(K, J, b, R, L, r)
+    bot_model.set_state(0)
+    ground_truth = bot_model.simulate_trajectory(all_t, vx, vy)
+
+    estimator = CartesianBotKF(K, J, b, R, L, r)
+    estimator.set_state(0)
+    nees = numpy.empty(num_steps)
+    nis = numpy.empty(num_steps)
+    sq_pos_error = numpy.empty(num_steps)
+    for i in range(num_steps):
+        xgt, ygt = ground_truth[i, 0], ground_truth[i, 3]
+        zx, zy, var_zx, var_zy, rho_zxy = generate_measurement(xgt, ygt, rng)
+        estimator.advance_filter(all_t[i], vx_nominal[i], vy_nominal[i],
+                                 zx, zy, vx_variance, vy_variance,
+                                 var_zx, var_zy, rho_zxy)
+        # innovation of this step from the prediction the filter kept
+        cov_zxy = rho_zxy * math.sqrt(var_zx) * math.sqrt(var_zy)
+        innovation = numpy.array([zx - estimator.predicted_state[0, 0],
+                                  zy - estimator.predicted_state[3, 0]])
+        S = estimator.predicted_state_cov[numpy.ix_((0, 3), (0, 3))] + \
+            numpy.array([[var_zx, cov_zxy],
+                         [cov_zxy, var_zy]])
+        nis[i] = innovation @ numpy.linalg.solve(S, innovation)
+        error = ground_truth[i] - estimator.state[:, 0]
+        nees[i] = error @ numpy.linalg.solve(estimator.state_cov, error)
+        sq_pos_error[i] = error[0] ** 2 + error[3] ** 2
+    return nees, nis, sq_pos_error
+
+def run_trials(trial_args, seeds):
+    # worker entry point: a batch of trials per task keeps the
+    # inter-process traffic down
+    return [ run_trial(seed, *trial_args) for seed in seeds ]
+
+def confidence_interval(dof, num_trials, probability = 0.95):
+    # two-sided interval for the average of num_trials chi-square
+    # variables with dof degrees of freedom
+    tail = (1 - probability) / 2
+    return chi2.ppf([tail, 1 - tail], dof * num_trials) / num_trials
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Monte Carlo consistency benchmark for the cartesian '
+        'bot Kalman filter: runs independent trials across a process pool '
+        'and reports average NEES/NIS against their chi-square bounds, '
+        'position RMSE and throughput.')
+    parser.add_argument('--trials', type=int, default=1000,
+                        help='number of Monte Carlo trials')
+    parser.add_argument('--steps', type=int, default=100,
+                        help='filter steps per trial')
+    parser.add_argument('--tstep', type=float, default=0.1,
+                        help='time step')
+    parser.add_argument('--vxvar', type=float, default=0.1,
+                        help='x input voltage variance')
+    parser.add_argument('--vyvar', type=float, default=0.2,
+                        help='y input voltage variance')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--batch', type=int, default=25,
+                        help='trials per worker task')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='root seed; every trial gets its own stream')
+    args = parser.parse_args()
+
+    seeds = numpy.random.SeedSequence(args.seed).spawn(args.trials)
+    batches = [ seeds[i:i + args.batch]
+                for i in range(0, args.trials, args.batch) ]
+    trial_args = (args.steps, args.tstep, args.vxvar, args.vyvar)
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers = args.workers) as executor:
+        results = [ trial
+                    for batch in executor.map(
+                        functools.partial(run_trials, trial_args), batches)
+                    for trial in batch ]
+    elapsed = time.time() - start
+
+    nees = numpy.array([ t[0] for t in results ])
+    nis = numpy.array([ t[1] for t in results ])
+    sq_pos_error = numpy.array([ t[2] for t in results ])
+    # averages over trials at every time step
+    mean_nees = nees.mean(axis = 0)
+    mean_nis = nis.mean(axis = 0)
+    nees_bounds = confidence_interval(6, args.trials)
+    nis_bounds = confidence_interval(2, args.trials)
+    nees_inside = numpy.mean((mean_nees >= nees_bounds[0]) &
+                             (mean_nees <= nees_bounds[1]))
+    nis_inside = numpy.mean((mean_nis >= nis_bounds[0]) &
+                            (mean_nis <= nis_bounds[1]))
+
+    print('trials: {}, steps: {}, workers: {}'.format(
+        args.trials, args.steps, args.workers))
+    print('throughput: {:.1f} trials/s ({:.2f} s total)'.format(
+        args.trials / elapsed, elapsed))
+    print('NEES: mean {:.3f} (expected 6), 95% bounds [{:.3f}, {:.3f}], '
+          '{:.1f}% of steps inside'.format(
+              mean_nees.mean(), *nees_bounds, 100 * nees_inside))
+    print('NIS: mean {:.3f} (expected 2), 95% bounds [{:.3f}, {:.3f}], '
+          '{:.1f}% of steps inside'.format(
+              mean_nis.mean(), *nis_bounds, 100 * nis_inside))
+    print('position RMSE: {:.4f} m (final step {:.4f} m)'.format(
+        math.sqrt(sq_pos_error.mean()),
+        math.sqrt(sq_pos_error[:, -1].mean())))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+from cartesian_bot_kf import CartesianBotKF, default_var
+import argparse
+import itertools
+import time
+import zipfile
+import numpy
+
+# motor parameters
+K = 0.01
+J = 0.01
+b = 0.1
+R = 1
+L = 0.5
+
+# wheel radius
+r = 0.25
+
+# columns every log must have and optional per-row noise parameters
+required_columns = ['t', 'v_x', 'v_y', 'z_x', 'z_y']
+optional_columns = ['var_vx', 'var_vy', 'var_zx', 'var_zy', 'rho_zxy']
+
+def output_columns():
+    return ['t'] + ['x{}'.format(i) for i in range(6)] + \
+        ['P{}{}'.format(i, j) for i in range(6) for j in range(6)]
+
+def _npy_chunks(path, chunk_size):
+    # a 2-D .npy log has one row per sample, column order as in
+    # required_columns followed by whatever optional columns are present
+    data = numpy.load(path, mmap_mode = 'r')
+    names = required_columns + optional_columns[:data.shape[1] - 5]
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = numpy.array(data[start:start + chunk_size], dtype = float)
+        yield { name: chunk[:, i] for i, name in enumerate(names) }
+
+def _npz_member_reader(archive, name):
+    # stream a 1-D array out of a (possibly compressed) .npz member
+    # without ever loading the whole member
+    stream = archive.open(name + '.npy')
+    if numpy.lib.format.read_magic(stream) == (1, 0):
+        shape, _, dtype = numpy.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, _, dtype = numpy.lib.format.read_array_header_2_0(stream)
+    if len(shape) != 1:
+        raise ValueError('npz log column {} is not 1-D'.format(name))
+    def read(count):
+        return numpy.frombuffer(stream.read(count * dtype.itemsize),
+                                dtype = dtype).astype(float)
+    return shape[0], read
+
+def _npz_chunks(path, chunk_size):
+    with zipfile.ZipFile(path) as archive:
+        members = [ n[:-4] for n in archive.namelist() ]
+        names = required_columns + \
+            [ n for n in optional_columns if n in members ]
+        readers = { n: _npz_member_reader(archive, n) for n in names }
+        length = readers['t'][0]
+        for _ in range(0, length, chunk_size):
+            yield { n: read(chunk_size) for n, (_, read) in readers.items() }
+
+def _csv_chunks(path, chunk_size):
+    # first line is the header naming the columns
+    with open(path) as f:
+        names = [ n.strip() for n in f.readline().split(',') ]
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            chunk = numpy.loadtxt(lines, delimiter = ',', ndmin = 2)
+            yield { n: chunk[:, i] for i, n in enumerate(names) }
+
+def count_rows(path):
+    if path.endswith('.npy'):
+        return numpy.load(path, mmap_mode = 'r').shape[0]
+    if path.endswith('.npz'):
+        with zipfile.ZipFile(path) as archive:
+            return _npz_member_reader(archive, 't')[0]
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+def read_log(path, chunk_size):
+    if path.endswith('.npy'):
+        chunks = _npy_chunks(path, chunk_size)
+    elif path.endswith('.npz'):
+        chunks = _npz_chunks(path, chunk_size)
+    else:
+        chunks = _csv_chunks(path, chunk_size)
+    for chunk in chunks:
+        missing = [ n for n in required_columns if n not in chunk ]
+        if missing:
+            raise ValueError('log is missing columns {}'.format(missing))
+        yield chunk
+
+def replay(estimator, chunks, var_v = default_var, var_z = default_var):
+    # feed each chunk through the filter and yield a chunk of output
+    # rows (time, state, flattened covariance)
+    initialized = estimator.time is not None
+    for chunk in chunks:
+        n = len(chunk['t'])
+        out = numpy.empty((n, 43))
+        columns = [ chunk['t'], chunk['v_x'], chunk['v_y'],
+                    chunk['z_x'], chunk['z_y'] ] + \
+            [ chunk.get(name, numpy.full(n, default))
+              for name, default in zip(optional_columns,
+                                       [var_v, var_v, var_z, var_z, 0]) ]
+        for i, row in enumerate(zip(*columns)):
+            if not initialized:
+                # start at the first sample; its zero-length predict
+                # step leaves the measurement update only
+                estimator.set_state(row[0])
+                initialized = True
+            estimator.advance_filter(*row)
+            out[i, 0] = row[0]
+            out[i, 1:7] = estimator.state[:, 0]
+            out[i, 7:] = estimator.state_cov.ravel()
+        yield out
+
+def write_csv(path, out_chunks):
+    rows = 0
+    with open(path, 'w') as f:
+        f.write(','.join(output_columns()) + '\n')
+        for out in out_chunks:
+            numpy.savetxt(f, out, delimiter = ',')
+            rows += len(out)
+    return rows
+
+def write_npy(path, out_chunks, num_rows):
+    out_file = numpy.lib.format.open_memmap(
+        path, mode = 'w+', dtype = float, shape = (num_rows, 43))
+    rows = 0
+    for out in out_chunks:
+        out_file[rows:rows + len(out)] = out
+        rows += len(out)
+        out_file.flush()
+    del out_file
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Replays a recorded log of input voltages and '
+        'position fixes through the cartesian bot Kalman filter, '
+        'streaming it in chunks so that memory use does not depend on '
+        'the log length. Logs are .npy (2-D, columns t, v_x, v_y, z_x, '
+        'z_y[, var_vx, var_vy, var_zx, var_zy, rho_zxy]), .npz (one 1-D '
+        'member per column) or CSV with a header line naming the columns.')
+    parser.add_argument('log', help='input log file')
+    parser.add_argument('output',
+                        help='output file for estimates and covariances '
+                        '(.npy or CSV)')
+    parser.add_argument('--chunk', type=int, default=4096,
+                        help='rows per chunk')
+    parser.add_argument('--varv', type=float, default=default_var,
+                        help='input voltage variance if the log has none')
+    parser.add_argument('--varz', type=float, default=default_var,
+                        help='measurement variance if the log has none')
+    parser.add_argument('--decoupled', action='store_true',
+                        help='use the axis-decoupled filter mode')
+    parser.add_argument('--steadystate', action='store_true',
+                        help='use the steady-state gain mode')
+    args = parser.parse_args()
+
+    estimator = CartesianBotKF(K, J, b, R, L, r,
+                               decoupled = args.decoupled,
+                               steady_state = args.steadystate)
+    out_chunks = replay(estimator, read_log(args.log, args.chunk),
+                        args.varv, args.varz)
+    start = time.time()
+    if args.output.endswith('.npy'):
+        rows = write_npy(args.output, out_chunks, count_rows(args.log))
+    else:
+        rows = write_csv(args.output, out_chunks)
+    elapsed = time.time() - start
+    print('replayed {} rows in {:.2f} s ({:.0f} rows/s)'.format(
+        rows, elapsed, rows / elapsed if elapsed > 0 else float('inf')))
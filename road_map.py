@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+import json
+import numpy as np
+
+# the grid index is subdivided this many times along each axis into a
+# finer raster recording, for every fine cell, the single segment that
+# holds all of it (or that no segment touches it); only points in the
+# remaining fine cells, along road edges and where roads overlap, are
+# tested against the segment rectangles
+raster_subdivision = 4
+
+class RoadMap:
+    def __init__(self, roads, route = None, cell_size = None):
+        # roads is a list of (points, width) pairs. Every polyline is
+        # driven from its first point towards its last and each of its
+        # segments covers a rectangle of the road width around it,
+        # extended by half the width past both ends so that consecutive
+        # segments join without gaps. The vehicle drives along route
+        # (the first road if not given).
+        starts = []
+        ends = []
+        half_widths = []
+        for points, width in roads:
+            points = np.asarray(points, dtype = float)
+            starts.append(points[:-1])
+            ends.append(points[1:])
+            half_widths.append(np.full(len(points) - 1, width / 2))
+        start = np.concatenate(starts)
+        end = np.concatenate(ends)
+        half_width = np.concatenate(half_widths)
+        length = np.hypot(*(end - start).T)
+        keep = length > 0
+        start, end = start[keep], end[keep]
+        half_width, length = half_width[keep], length[keep]
+        direction = (end - start) / length[:, None]
+        self.roads = roads
+        self.num_segments = len(start)
+        # one extra sentinel segment at the end that holds no point and
+        # has no direction; index padding and lookup misses point at it
+        self.start = np.vstack([start, [[0, 0]]])
+        self.end = np.vstack([end, [[0, 0]]])
+        self.direction = np.vstack([direction, [[0, 0]]])
+        self.length = np.append(length, 0)
+        self.half_width = np.append(half_width, 0)
+        # containment test in the frame of every segment: a point is in
+        # it when its projections on the direction and on the normal
+        # fall within these bounds (never, for the sentinel)
+        along = np.einsum('ij,ij->i', self.start, self.direction)
+        across = self.start[:, 1] * self.direction[:, 0] - \
+            self.start[:, 0] * self.direction[:, 1]
+        self._frame = np.array([
+            self.direction[:, 0], self.direction[:, 1],
+            along - self.half_width, along + self.length + self.half_width,
+            across - self.half_width, across + self.half_width ])
+
+        self.route = np.asarray(roads[0][0] if route is None else route,
+                                dtype = float)
+        route_lengths = np.hypot(*np.diff(self.route, axis = 0).T)
+        self.route_cumulative = np.concatenate([[0], np.cumsum(route_lengths)])
+        self.route_length = self.route_cumulative[-1]
+
+        if cell_size is None:
+            cell_size = 2 * half_width.min()
+        self._build_index(cell_size)
+        self._build_raster(raster_subdivision)
+
+    def _build_index(self, cell_size):
+        # uniform grid; every cell lists the segments whose rectangle may
+        # overlap it, padded to the same count with the sentinel
+        n = self.num_segments
+        start = self.start[:n]
+        end = self.end[:n]
+        # a segment rectangle lies within half_width * sqrt(2) of the
+        # segment and a cell within half its diagonal of its center
+        reach = self.half_width[:n] * np.sqrt(2)
+        low = np.minimum(start, end) - reach[:, None]
+        high = np.maximum(start, end) + reach[:, None]
+        self.origin = low.min(axis = 0)
+        self.cell_size = cell_size
+        self.grid_shape = np.floor(
+            (high.max(axis = 0) - self.origin) / cell_size).astype(int) + 1
+        num_cells = self.grid_shape[0] * self.grid_shape[1]
+        margin = cell_size * np.sqrt(2) / 2
+        cell_ids = []
+        segment_ids = []
+        for i in range(n):
+            lo = np.floor((low[i] - self.origin) / cell_size).astype(int)
+            hi = np.floor((high[i] - self.origin) / cell_size).astype(int)
+            ix, iy = np.meshgrid(np.arange(lo[0], hi[0] + 1),
+                                 np.arange(lo[1], hi[1] + 1), indexing = 'ij')
+            ix = ix.ravel()
+            iy = iy.ravel()
+            center_x = self.origin[0] + (ix + 0.5) * cell_size
+            center_y = self.origin[1] + (iy + 0.5) * cell_size
+            distance = self._segment_distance(i, center_x, center_y)
+            near = distance <= reach[i] + margin
+            cell_ids.append(ix[near] * self.grid_shape[1] + iy[near])
+            segment_ids.append(np.full(near.sum(), i))
+        cell_ids = np.concatenate(cell_ids)
+        segment_ids = np.concatenate(segment_ids)
+        order = np.argsort(cell_ids, kind = 'stable')
+        cell_ids = cell_ids[order]
+        segment_ids = segment_ids[order]
+        counts = np.bincount(cell_ids, minlength = num_cells)
+        first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        rank = np.arange(len(cell_ids)) - first[cell_ids]
+        # stored (K, cells) so that gathering it for N points gives rows
+        # of N, along which all the per-point arithmetic runs; the extra
+        # last column is the (empty) cell for points off the grid
+        self.index = np.full((max(counts.max(), 1), num_cells + 1), n)
+        self.index[rank, cell_ids] = segment_ids
+        self.num_cells = num_cells
+
+    def _build_raster(self, subdivision):
+        # a fine cell holds the segment that contains all four of its
+        # corners when every other candidate segment of its grid cell
+        # stays clear of it, the sentinel when all of them do, and -1
+        # (undecided) otherwise; the extra last entry is for points off
+        # the grid
+        n = self.num_segments
+        self.raster_size = self.cell_size / subdivision
+        self.raster_shape = self.grid_shape * subdivision
+        fx, fy = np.meshgrid(np.arange(self.raster_shape[0]),
+                             np.arange(self.raster_shape[1]),
+                             indexing = 'ij')
+        fx = fx.ravel()
+        fy = fy.ravel()
+        candidates = self.index[:, (fx // subdivision) * self.grid_shape[1] +
+                                fy // subdivision]
+        corner_x = self.origin[0] + np.array([fx, fx + 1]) * self.raster_size
+        corner_y = self.origin[1] + np.array([fy, fy + 1]) * self.raster_size
+        center_x = corner_x.mean(axis = 0)
+        center_y = corner_y.mean(axis = 0)
+        # margins against rounding when points are binned into fine cells
+        tolerance = 1e-9 * self.cell_size
+        reach = self.raster_size * np.sqrt(2) / 2 + tolerance
+        covering = np.zeros(candidates.shape, dtype = bool)
+        clear = np.zeros(candidates.shape, dtype = bool)
+        for k, segment in enumerate(candidates):
+            direction_x, direction_y, along_low, along_high, \
+                across_low, across_high = np.take(self._frame, segment,
+                                                  axis = 1)
+            inside = np.ones(len(segment), dtype = bool)
+            for x in corner_x:
+                for y in corner_y:
+                    along = x * direction_x + y * direction_y
+                    across = y * direction_x - x * direction_y
+                    inside &= (along > along_low + tolerance) & \
+                        (along < along_high - tolerance) & \
+                        (across > across_low + tolerance) & \
+                        (across < across_high - tolerance)
+            covering[k] = inside
+            # distance from the fine cell center to the rectangle
+            along = center_x * direction_x + center_y * direction_y
+            across = center_y * direction_x - center_x * direction_y
+            along_gap = np.maximum(np.abs(along - (along_low + along_high) / 2)
+                                   - (along_high - along_low) / 2, 0)
+            across_gap = np.maximum(
+                np.abs(across - (across_low + across_high) / 2) -
+                (across_high - across_low) / 2, 0)
+            clear[k] = (np.hypot(along_gap, across_gap) > reach) | \
+                (segment == n)
+        settled = covering.sum(axis = 0) <= 1
+        settled &= (covering | clear).all(axis = 0)
+        raster = np.full(len(fx), n)
+        for k in range(len(candidates) - 1, -1, -1):
+            np.copyto(raster, candidates[k], where = covering[k])
+        raster[~settled] = -1
+        self.raster = np.append(raster, n)
+        self.num_raster_cells = len(fx)
+
+    def _segment_distance(self, i, x, y):
+        # distance from points to the center line of segment i
+        dx = x - self.start[i, 0]
+        dy = y - self.start[i, 1]
+        u = np.clip(dx * self.direction[i, 0] + dy * self.direction[i, 1],
+                    0, self.length[i])
+        return np.hypot(dx - u * self.direction[i, 0],
+                        dy - u * self.direction[i, 1])
+
+    def _raster_segments(self, x, y):
+        # the one segment holding every point according to the raster,
+        # the sentinel for points off the road and -1 where undecided
+        fx = np.floor((x - self.origin[0]) / self.raster_size)
+        fy = np.floor((y - self.origin[1]) / self.raster_size)
+        inside = (fx >= 0) & (fx < self.raster_shape[0]) & \
+            (fy >= 0) & (fy < self.raster_shape[1])
+        cell = np.where(inside, fx * self.raster_shape[1] + fy,
+                        self.num_raster_cells).astype(int)
+        # np.take is several times faster than fancy indexing here
+        return np.take(self.raster, cell)
+
+    def locate(self, x, y):
+        # segments that may hold every point and whether the point lies in
+        # each of them, both (K, N); pass the result to pick_directions()
+        # to branch several times off one lookup. Points in settled fine
+        # cells get their one segment (or none) straight from the raster.
+        segment = self._raster_segments(x, y)
+        segments = np.full((len(self.index), len(x)), self.num_segments)
+        segments[0] = segment
+        contained = np.zeros(segments.shape, dtype = bool)
+        np.less(segment, self.num_segments, out = contained[0])
+        undecided = np.flatnonzero(segment < 0)
+        if undecided.size:
+            undecided_segments, undecided_contained = self._locate_in_index(
+                x[undecided], y[undecided])
+            for k in range(len(segments)):
+                segments[k, undecided] = undecided_segments[k]
+                contained[k, undecided] = undecided_contained[k]
+        return segments, contained
+
+    def _locate_in_index(self, x, y):
+        # locate() by testing every point against all candidate segments
+        # of its grid cell
+        ix = np.floor((x - self.origin[0]) / self.cell_size)
+        iy = np.floor((y - self.origin[1]) / self.cell_size)
+        inside = (ix >= 0) & (ix < self.grid_shape[0]) & \
+            (iy >= 0) & (iy < self.grid_shape[1])
+        cell = np.where(inside, ix * self.grid_shape[1] + iy,
+                        self.num_cells).astype(int)
+        segments = np.take(self.index, cell, axis = 1)
+        direction_x, direction_y, along_low, along_high, \
+            across_low, across_high = np.take(self._frame, segments, axis = 1)
+        along = x * direction_x
+        along += y * direction_y
+        across = y * direction_x
+        across -= x * direction_y
+        contained = along > along_low
+        contained &= along < along_high
+        contained &= across > across_low
+        contained &= across < across_high
+        return segments, contained
+
+    def contains(self, x, y):
+        # works element-wise on arrays of coordinates as well as on scalars
+        scalar = np.ndim(x) == 0 and np.ndim(y) == 0
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        segment = self._raster_segments(x, y)
+        inside = (segment >= 0) & (segment < self.num_segments)
+        undecided = np.flatnonzero(segment < 0)
+        if undecided.size:
+            _, contained = self._locate_in_index(x[undecided], y[undecided])
+            inside[undecided] = contained.any(axis = 0)
+        return bool(inside[0]) if scalar else inside
+
+    def pick_directions(self, segments, contained, rng):
+        # unit direction of travel at every point located by locate(),
+        # taken from one of the segments holding it at random (so
+        # intersections and corners branch); zero for points off the road
+        count = contained.sum(axis = 0)
+        # the first segment holding the point, which is the only one for
+        # most points; only the rest go through the random pick
+        segment = np.full(len(count), self.num_segments)
+        for k in range(len(segments) - 1, -1, -1):
+            np.copyto(segment, segments[k], where = contained[k])
+        branching = np.flatnonzero(count > 1)
+        if branching.size:
+            contained = contained[:, branching]
+            pick = np.floor(rng.random(len(branching)) * count[branching])
+            rank = np.cumsum(contained, axis = 0) - 1
+            chosen = np.argmax(contained & (rank == pick), axis = 0)
+            segment[branching] = np.take_along_axis(
+                segments[:, branching], chosen[None], axis = 0)[0]
+        return np.take(self.direction, segment, axis = 0)
+
+    def directions(self, x, y, rng):
+        # pick_directions() for points given by their coordinates; a
+        # scalar point gives a single direction
+        scalar = np.ndim(x) == 0 and np.ndim(y) == 0
+        direction = self.pick_directions(
+            *self.locate(np.atleast_1d(x), np.atleast_1d(y)), rng)
+        return direction[0] if scalar else direction
+
+    def route_position(self, distance):
+        # point at the given distance along the route, extrapolated along
+        # the first and last segments outside of it; an array of
+        # distances gives an array of points
+        i = np.clip(np.searchsorted(self.route_cumulative, distance,
+                                    side = 'right') - 1,
+                    0, len(self.route) - 2)
+        a = self.route[i]
+        b = self.route[i + 1]
+        fraction = (distance - self.route_cumulative[i]) / \
+            (self.route_cumulative[i + 1] - self.route_cumulative[i])
+        return a + np.expand_dims(fraction, -1) * (b - a)
+
+    def segment_polygons(self):
+        # (S, 4, 2) corners of every segment rectangle, for drawing
+        n = self.num_segments
+        along = self.direction[:n] * self.half_width[:n, None]
+        across = along[:, ::-1] * [-1, 1]
+        start = self.start[:n] - along
+        end = self.end[:n] + along
+        return np.stack([start - across, end - across,
+                         end + across, start + across], axis = 1)
+
+    def route_bounds(self):
+        return self.route.min(axis = 0), self.route.max(axis = 0)
+
+    def max_width(self):
+        return 2 * self.half_width[:self.num_segments].max()
+
+def default_map(x_vert, y_horiz, road_width):
+    # the original L-shaped corner: up the vertical segment at x_vert,
+    # then left along the horizontal one at y_horiz. The roads run well
+    # past both ends of the route so the particle cloud is never clipped.
+    extent = x_vert + y_horiz
+    road = [ (x_vert, -extent), (x_vert, y_horiz), (-extent, y_horiz) ]
+    route = [ (x_vert, 0), (x_vert, y_horiz), (0, y_horiz) ]
+    return RoadMap([ (road, road_width) ], route)
+
+def load_map(path):
+    # JSON map: {"width": w, "roads": [...], "route": [[x, y], ...],
+    # "cell_size": c}. A road is either a list of [x, y] points or an
+    # object {"points": [...], "width": w, "closed": true} where closed
+    # roads (polygon loops) return to their first point.
+    with open(path) as f:
+        spec = json.load(f)
+    width = spec.get('width', 1)
+    roads = []
+    for road in spec['roads']:
+        if isinstance(road, dict):
+            points = road['points']
+            if road.get('closed', False):
+                points = points + points[:1]
+            roads.append((points, road.get('width', width)))
+        else:
+            roads.append((road, width))
+    return RoadMap(roads, spec.get('route'), spec.get('cell_size'))
@@ -1,166 +1,358 @@
 #!/usr/bin/env python
 import matplotlib.pyplot as plt
-import random
+from matplotlib.collections import PolyCollection
+from road_map import default_map, load_map
+from statistics import NormalDist
 import time
-from scipy.stats import norm
 import numpy as np
 import argparse
 
+# particles that cannot find an on-road move after this many redraws
+# (e.g. at a dead end) stay where they are
+max_motion_attempts = 100
+
+# KLD-sampling defaults: bound on the KL divergence between the particle
+# and the true posterior, probability of exceeding it, histogram bin size
+default_kld_epsilon = 0.05
+default_kld_delta = 0.01
+default_kld_bin_size = 0.2
+
+# above this many particles the display thins them out or draws their
+# density instead of every point
+default_max_points = 5000
+density_modes = [ 'sample', 'histogram' ]
+
+resample_methods = [ 'multinomial', 'systematic', 'stratified', 'residual' ]
+
+# The particle-set steps below work on one particle set, particles
+# (N, 2) and weights (N,), or on a batch of them, particles (M, N, 2)
+# and weights (M, N), with the particle axis last in the weights.
+
+def _search_weights(weights, positions, rows = None):
+    # indices of the particles at positions (each in [0, 1)) along the
+    # cumulative weights of rows of the (M, N) weights, positions being
+    # (M, k), one row of them per weight row, or flat with the weight
+    # row of each in rows. Returns indices into each row.
+    m, n = weights.shape
+    cumulative = np.cumsum(weights, axis = 1)
+    # guard against the sums rounding to slightly below one
+    cumulative[:, -1] = 1
+    if m == 1:
+        return np.searchsorted(cumulative[0], positions)
+    # row r's cumulative weights are shifted to [r, r + 1], which makes
+    # the flattened array monotonic, so a single searchsorted serves
+    # every row
+    if rows is None:
+        rows = np.arange(m)[:, None]
+    cumulative += np.arange(m)[:, None]
+    indices = np.searchsorted(cumulative.ravel(), positions + rows)
+    indices -= rows * n
+    # keep rounding at a row boundary from spilling into the next row
+    return np.clip(indices, 0, n - 1, out = indices)
+
+def _resample_rows(weights, n, draw):
+    # runs a scheme over the rows of (..., N) weights; draw gets the
+    # weights as (M, N) rows and the sample size and returns (M, n)
+    # indices into each row
+    rows = weights.reshape(-1, weights.shape[-1])
+    if n is None:
+        n = rows.shape[1]
+    return draw(rows, n).reshape(weights.shape[:-1] + (n,))
+
+def multinomial_indices(weights, rng, n = None):
+    def draw(weights, n):
+        positions = np.sort(rng.random((len(weights), n)), axis = 1)
+        return _search_weights(weights, positions)
+    return _resample_rows(weights, n, draw)
+
+def systematic_indices(weights, rng, n = None):
+    # a single random offset shared by n evenly spaced positions
+    def draw(weights, n):
+        positions = (rng.random((len(weights), 1)) + np.arange(n)) / n
+        return _search_weights(weights, positions)
+    return _resample_rows(weights, n, draw)
+
+def stratified_indices(weights, rng, n = None):
+    # one random position inside each of n equal strata
+    def draw(weights, n):
+        positions = (rng.random((len(weights), n)) + np.arange(n)) / n
+        return _search_weights(weights, positions)
+    return _resample_rows(weights, n, draw)
+
+def residual_indices(weights, rng, n = None):
+    # floor(n * w) copies of every particle deterministically, the rest
+    # drawn multinomially from what is left over
+    def draw(weights, n):
+        m, size = weights.shape
+        scaled = n * weights
+        copies = np.floor(scaled).astype(int)
+        kept = np.repeat(np.arange(m * size), copies.ravel())
+        remaining = n - copies.sum(axis = 1)
+        drawing = np.flatnonzero(remaining)
+        if m == 1:
+            if not drawing.size:
+                return kept[None]
+            residuals = scaled - copies
+            residuals /= residuals.sum()
+            positions = np.sort(rng.random(remaining[0]))
+            return np.concatenate(
+                [ kept, _search_weights(residuals, positions) ])[None]
+        if not drawing.size:
+            return (kept % size).reshape(m, n)
+        residuals = scaled[drawing] - copies[drawing]
+        residuals /= residuals.sum(axis = 1, keepdims = True)
+        rows = np.repeat(np.arange(len(drawing)), remaining[drawing])
+        positions = rng.random(len(rows))
+        positions = positions[np.lexsort((positions, rows))]
+        drawn = _search_weights(residuals, positions, rows)
+        # every row's copies first, then its drawn particles
+        indices = np.concatenate([ kept % size, drawn ])
+        order = np.argsort(np.concatenate([ kept // size, drawing[rows] ]),
+                           kind = 'stable')
+        return indices[order].reshape(m, n)
+    return _resample_rows(weights, n, draw)
+
+resample_indices = {
+    'multinomial': multinomial_indices,
+    'systematic': systematic_indices,
+    'stratified': stratified_indices,
+    'residual': residual_indices,
+}
+
+def initial_particles(road_map, center, num_particles, var, rng):
+    # num_particles normally distributed particles around the (2,)
+    # center, or around each of the (M, 2) centers, with the ones off
+    # the road redrawn until every one is on it
+    center = np.asarray(center, dtype = float)
+    centers = np.repeat(center.reshape(-1, 2), num_particles, axis = 0)
+    particles = centers + rng.normal(scale = np.sqrt(var),
+                                     size = centers.shape)
+    pending = np.flatnonzero(~road_map.contains(particles[:, 0],
+                                                particles[:, 1]))
+    while pending.size:
+        particles[pending] = centers[pending] + rng.normal(
+            scale = np.sqrt(var), size = (len(pending), 2))
+        on_road = road_map.contains(particles[pending, 0],
+                                    particles[pending, 1])
+        pending = pending[~on_road]
+    return particles.reshape(center.shape[:-1] + (num_particles, 2))
+
+def move_on_road(road_map, particles, step, std, rng):
+    # moves all particles at once; the ones that land off the road are
+    # redrawn (direction choice included) until every one is on it. The
+    # particles are located on the map once, retries only pick again
+    # among the segments holding them.
+    shape = particles.shape
+    particles = particles.reshape(-1, 2)
+    segments, contained = road_map.locate(particles[:, 0], particles[:, 1])
+    def move(particles, segments, contained):
+        # follow the direction of the road segment under the particle,
+        # picking one at random where segments overlap
+        candidates = rng.standard_normal(particles.shape)
+        candidates *= std
+        candidates += particles
+        candidates += step * road_map.pick_directions(segments, contained,
+                                                      rng)
+        return candidates, road_map.contains(candidates[:, 0],
+                                             candidates[:, 1])
+    moved, on_road = move(particles, segments, contained)
+    pending = np.flatnonzero(~on_road)
+    for _ in range(max_motion_attempts):
+        if not pending.size:
+            break
+        candidates, on_road = move(particles[pending],
+                                   segments[:, pending],
+                                   contained[:, pending])
+        moved[pending[on_road]] = candidates[on_road]
+        pending = pending[~on_road]
+    moved[pending] = particles[pending]
+    return moved.reshape(shape)
+
+def log_likelihood(particles, measurement_x, measurement_y,
+                   measurement_variance):
+    # log of norm.pdf(distance to measurement,
+    # scale = measurement_variance), dropping the constant term
+    dx = particles[..., 0] - measurement_x
+    dy = particles[..., 1] - measurement_y
+    return -0.5 * (dx * dx + dy * dy) / \
+        (measurement_variance * measurement_variance)
+
+def normalize_log_weights(log_importance):
+    # normalizes the log weights in place along the particle axis and
+    # returns the weights; normalizing in the log domain (log-sum-exp)
+    # keeps them from underflowing to zero when the measurement variance
+    # is small
+    log_importance -= log_importance.max(axis = -1, keepdims = True)
+    particle_importance = np.exp(log_importance)
+    total = particle_importance.sum(axis = -1, keepdims = True)
+    particle_importance /= total
+    log_importance -= np.log(total)
+    return particle_importance
+
+def effective_sample_size(particle_importance):
+    return 1 / np.einsum('...i,...i->...', particle_importance,
+                         particle_importance)
+
+def weighted_mean(particle_importance, particles):
+    return np.einsum('...i,...ik->...k', particle_importance, particles)
+
 class RoadTrackSim:
-    def __init__(self, x_vert, y_horiz, road_width,
+    def __init__(self, road_map,
                  velocity, velocity_variance, measurement_variance,
-                 num_particles, randomize_velocity, display_measurement):
-        self.fig, self.ax = plt.subplots()
+                 num_particles, randomize_velocity,
+                 resample_method = 'systematic', resample_threshold = 0.5,
+                 seed = None, min_particles = None, max_particles = None,
+                 kld_epsilon = default_kld_epsilon,
+                 kld_delta = default_kld_delta,
+                 kld_bin_size = default_kld_bin_size):
+        # filter core only, rendering lives in RoadTrackDisplay
+        self.rng = np.random.default_rng(seed)
+        # with max_particles set, the particle count adapts by KLD-sampling
+        # within [min_particles, max_particles] every time it resamples
+        self.min_particles = min_particles or 1
+        self.max_particles = max_particles
+        if max_particles is not None:
+            num_particles = min(max(num_particles, self.min_particles),
+                                max_particles)
+        self.kld_epsilon = kld_epsilon
+        self.kld_z = NormalDist().inv_cdf(1 - kld_delta)
+        self.kld_bin_size = kld_bin_size
         self.num_particles = num_particles
-        self.particle_plot, = self.ax.plot([], [], 'g.')
-        self.gt_plot, = self.ax.plot([], [], 'bx')
-        self.measurement_plot, = self.ax.plot([], [], 'ro')
-        self.display_measurement = display_measurement
         self.velocity = velocity
         self.velocity_variance = velocity_variance
         self.randomize_velocity = randomize_velocity
         self.measurement_variance = measurement_variance
-        self.x_vert = x_vert
-        self.y_horiz = y_horiz
-        self.road_width = road_width
-        self.x1 = self.x_vert - self.road_width / 2
-        self.x2 = self.x_vert + self.road_width / 2
-        self.y1 = self.y_horiz - self.road_width / 2
-        self.y2 = self.y_horiz + self.road_width / 2
-        self.plot_road()
-        self.fig.gca().set_aspect('equal', adjustable='box')
+        # resample only when the effective sample size drops below
+        # resample_threshold * num_particles (1 resamples every step)
+        self.resample_method = resample_method
+        self.resample_threshold = resample_threshold
+        self.resample_count = 0
+        self.road_map = road_map
         self.time = 0
-        self.gt_x = x_vert
-        self.gt_y = 0
+        # the vehicle drives along the map route
+        self.route_distance = 0
+        self.gt_x, self.gt_y = road_map.route_position(0)
         self.measurement_x = None
         self.measurement_y = None
         self.init_particles(var = 1)
 
     def is_on_road(self, x, y):
-        if x > self.x1 and x < self.x2 and y < self.y2:
-            return True
-        if y > self.y1 and y < self.y2 and x < self.x2:
-            return True
-        return False
+        # works element-wise on arrays of coordinates
+        return self.road_map.contains(x, y)
 
-    def init_particles(self, var):
-        def get_particles(mean, cov, num):
-            return [ tuple(x) for x in np.random.multivariate_normal(
-                mean, cov, num) ]
-        def prune_particles(particles):
-            return [ p for p in particles if self.is_on_road(*p) ]
-        particles = []
-        while len(particles) < self.num_particles:
-            particles += prune_particles(
-                get_particles([self.gt_x, self.gt_y],
-                              [[var, 0 ],[0, var]],
-                              self.num_particles))
-        self.particles = particles[0:self.num_particles]
+    def initial_particles(self, var):
+        # particles are held as an (N, 2) array of x, y coordinates
+        return initial_particles(self.road_map, [ self.gt_x, self.gt_y ],
+                                 self.num_particles, var, self.rng)
 
-    def plot_road(self):
-        # road edges
-        self.ax.plot([self.x1, self.x1], [0, self.y1], color='black')
-        self.ax.plot([self.x2, self.x2], [0, self.y2], color='black')
-        self.ax.plot([self.x1, -self.road_width], [self.y1, self.y1], color='black')
-        self.ax.plot([self.x2, -self.road_width], [self.y2, self.y2], color='black')
-
-        # fill the insides of the road
-        road_vertices = [
-            (self.x1, 0), (self.x1, self.y1), (-self.road_width, self.y1),
-            (-self.road_width, self.y2), (self.x2, self.y2), (self.x2, 0)
-        ]
-        self.ax.fill(*zip(*road_vertices), color='gray', alpha=0.5)
-
-        # set the plot limits
-        padding = self.road_width + np.sqrt(self.measurement_variance)
-        self.ax.set_xlim(-padding, self.x_vert + padding)
-        self.ax.set_ylim(-padding / 2, self.y_horiz + padding)
-        self.ax.grid()
+    def init_particles(self, var):
+        particles = self.initial_particles(var)
+        # resampling gathers into the spare buffer, then the two swap;
+        # both can hold the largest particle count
+        capacity = max(self.num_particles, self.max_particles or 0)
+        self._particle_storage = np.empty((capacity, 2))
+        self._particle_buffer = np.empty((capacity, 2))
+        self.particles = self._particle_storage[:self.num_particles]
+        self.particles[:] = particles
+        # log weights carried between steps that skip resampling
+        self.log_importance = np.zeros(self.num_particles)
+        self.particle_importance = np.full(self.num_particles,
+                                           1 / self.num_particles)
 
     def move_vehicle(self, time):
         if self.randomize_velocity:
-            velocity = np.random.normal(loc = self.velocity,
+            velocity = self.rng.normal(loc = self.velocity,
                                         scale = np.sqrt(self.velocity_variance))
         else:
             velocity = self.velocity
         delta_t = time - self.time
-        if self.gt_y < self.y_horiz:
-            self.gt_y += velocity * delta_t
-            delta_x = self.gt_y - self.y_horiz
-            if delta_x > 0:
-                self.gt_y = self.y_horiz
-                self.gt_x -= delta_x
-        elif self.gt_x > 0:
-            self.gt_x -= velocity * delta_t
-
-    def apply_motion_model(self, x, y, delta_t):
-        def move_up(x, y, delta_t):
-            return np.random.multivariate_normal(
-                    mean = [ x, y + self.velocity * delta_t],
-                    cov = [
-                        [ self.velocity_variance * delta_t * delta_t, 0 ],
-                        [ 0, self.velocity_variance * delta_t * delta_t ]
-                    ]
-                )
-        def move_left(x, y, delta_t):
-            return np.random.multivariate_normal(
-                mean = [ x - self.velocity * delta_t, y],
-                cov = [
-                    [ self.velocity_variance * delta_t * delta_t, 0 ],
-                    [ 0, self.velocity_variance * delta_t * delta_t ]
-                ]
-            )
+        if not self.done():
+            self.route_distance += velocity * delta_t
+            self.gt_x, self.gt_y = \
+                self.road_map.route_position(self.route_distance)
 
-        while True:
-            if x > self.x1 and y > self.y1:
-                # intersection, moving in either direction
-                if random.choice([True, False]):
-                    x_new, y_new = move_up(x, y, delta_t)
-                else:
-                    x_new, y_new = move_left(x, y, delta_t)
-            elif x > self.x1:
-                # vertical road segment, moving up
-                x_new, y_new = move_up(x, y, delta_t)
-            else:
-                # horizontal road segment, moving left
-                x_new, y_new = move_left(x, y, delta_t)
-            if self.is_on_road(x_new, y_new):
-                break
-        return x_new, y_new
+    def apply_motion_model(self, particles, delta_t):
+        return move_on_road(self.road_map, particles,
+                            self.velocity * delta_t,
+                            np.sqrt(self.velocity_variance) * delta_t,
+                            self.rng)
 
     def move_particles(self, time):
         delta_t = time - self.time
-        self.predicted_particles = [
-            self.apply_motion_model(*p, delta_t) for p in self.particles
-        ]
+        self.predicted_particles = self.apply_motion_model(
+            self.particles, delta_t)
 
     def generate_measurement(self):
         self.measurement_x, self.measurement_y = \
-            np.random.multivariate_normal(
+            self.rng.multivariate_normal(
                 mean = [ self.gt_x, self.gt_y ],
                 cov = [[ self.measurement_variance, 0 ],
                        [ 0, self.measurement_variance ]])
 
+    def log_likelihood(self, particles):
+        return log_likelihood(particles, self.measurement_x,
+                              self.measurement_y, self.measurement_variance)
+
     def score_particles(self):
-        particle_importance = [
-            norm.pdf(np.linalg.norm([x - self.measurement_x,
-                                     y - self.measurement_y]),
-                     scale = self.measurement_variance) \
-            for x, y in self.predicted_particles
-        ]
-        self.particle_importance = [
-            x / sum(particle_importance) for x in particle_importance ]
+        self.log_importance = self.log_importance + \
+            self.log_likelihood(self.predicted_particles)
+        self.particle_importance = normalize_log_weights(self.log_importance)
+
+    def effective_sample_size(self):
+        return effective_sample_size(self.particle_importance)
+
+    def kld_particle_count(self, occupied_bins):
+        # KLD-sampling bound (Fox, 2003): particles needed so that with
+        # probability 1 - kld_delta the KL divergence between the sample
+        # approximation and a posterior occupying that many histogram
+        # bins stays below kld_epsilon
+        if occupied_bins < 2:
+            return self.min_particles
+        k = occupied_bins - 1
+        a = 2 / (9 * k)
+        count = k / (2 * self.kld_epsilon) * \
+            (1 - a + np.sqrt(a) * self.kld_z) ** 3
+        return int(min(max(np.ceil(count), self.min_particles),
+                       self.max_particles))
+
+    def occupied_bins(self, particles):
+        # number of non-empty cells of a kld_bin_size histogram
+        bins = np.floor(particles / self.kld_bin_size).astype(np.int64)
+        return len(np.unique((bins[:, 0] << 32) + bins[:, 1]))
 
     def resample(self):
-        sample_indices = np.random.choice(
-            np.arange(0, self.num_particles), size = self.num_particles,
-            p = self.particle_importance)
-        self.particles = [
-            self.predicted_particles[i] for i in sample_indices
-        ]
+        if self.effective_sample_size() >= \
+           self.resample_threshold * self.num_particles:
+            # weights are still healthy, keep them for the next step
+            self.particles = self.predicted_particles
+            return False
+        scheme = resample_indices[self.resample_method]
+        sample_indices = scheme(self.particle_importance, self.rng)
+        if self.max_particles is not None:
+            # size the new set by the bins the resampled posterior
+            # occupies and redraw at that size if it changed
+            count = self.kld_particle_count(self.occupied_bins(
+                self.predicted_particles[sample_indices]))
+            if count != self.num_particles:
+                sample_indices = scheme(self.particle_importance,
+                                        self.rng, count)
+                self.num_particles = count
+                self.log_importance = np.zeros(count)
+                self.particle_importance = np.empty(count)
+        self.particles = self._particle_buffer[:self.num_particles]
+        np.take(self.predicted_particles, sample_indices, axis = 0,
+                out = self.particles)
+        self._particle_buffer, self._particle_storage = \
+            self._particle_storage, self._particle_buffer
+        self.log_importance.fill(0)
+        self.particle_importance.fill(1 / self.num_particles)
+        self.resample_count += 1
+        return True
 
     def fake_resample(self):
         self.particles = self.predicted_particles
+        self.log_importance.fill(0)
+        self.particle_importance.fill(1 / self.num_particles)
 
     def advance_time(self, time):
         self.time = time
@@ -168,92 +360,332 @@ class RoadTrackSim:
     def get_time(self):
         return self.time
 
-    def redraw(self):
-        self.gt_plot.set_data(self.gt_x, self.gt_y)
-        if self.display_measurement:
-            self.measurement_plot.set_data(
-                self.measurement_x, self.measurement_y)
-        self.particle_plot.set_data(
-            [ x[0] for x in self.particles ],
-            [ x[1] for x in self.particles ])
-        self.fig.canvas.draw()
-        self.fig.canvas.flush_events()
-
-def display_sleep(now):
-    elapsed_wall_clock_time = time.time() - now
-    sleep_time = delta_t - elapsed_wall_clock_time
-    if sleep_time > 0:
-        time.sleep(sleep_time)
+    def done(self):
+        # the vehicle has driven off the end of the route
+        return self.route_distance >= self.road_map.route_length
 
-parser = argparse.ArgumentParser(
-    description = 'Simulates the fusion between the map information and GPS.'
-    'The vehicle is assumed to be moving at velocity v following the road.'
-    'It is assumed that the velocity is known with specified variance'
-    'GPS error is modeled as zero-mean Gaussian process with specified variance'
-)
-parser.add_argument('--xvert', type=float, default=5,
-                  help='x coordinate of the vertical road segment')
-parser.add_argument('--yhoriz', type=float, default=10,
-                  help='y coordinate of the horizontal road segment')
-parser.add_argument('--rwidth', type=float, default=1,
-                  help='road width')
-parser.add_argument('--vvel', type=float, default=1,
-                  help='nominal vehicle velocity')
-parser.add_argument('--vvar', type=float, default=0.2,
-                  help='vehicle velocioty variance')
-parser.add_argument('--mvar', type=float, default=1,
-                  help='measurement variance')
-parser.add_argument('--npart', type=int, default=500,
-                  help='number of particles to use')
-parser.add_argument('--randvel', action='store_true',
-                    help='randomize vehicle true velocity')
-parser.add_argument('--noresample', action='store_true',
-                    help='turn off resampling, reducing the filter prediction')
-parser.add_argument('--step', action='store_true',
-                    help='single-step the filter')
-args = parser.parse_args()
-
-road_track = RoadTrackSim(
-    x_vert = args.xvert,
-    y_horiz = args.yhoriz,
-    road_width = args.rwidth,
-    velocity = args.vvel,
-    velocity_variance = args.vvar,
-    measurement_variance = args.mvar,
-    num_particles = args.npart,
-    randomize_velocity = args.randvel,
-    display_measurement = not args.noresample)
-
-# enter interactive mode and show the plot
-plt.ion()
-plt.show()
-
-if args.step:
-    print('single step mode, press ENTER to advance the simulation')
-delta_t = 0.1
-while True:
-    now = time.time()
-    if road_track.gt_x > 0:
-        t = road_track.get_time() + delta_t
+    def get_estimate(self):
+        # weighted mean; weights are uniform right after resampling
+        return weighted_mean(self.particle_importance, self.particles)
+
+    def step(self, delta_t, resample = True):
+        t = self.time + delta_t
 
         # ground truth simulation
-        road_track.move_vehicle(t)
+        self.move_vehicle(t)
 
         # filter simulation
-        road_track.move_particles(t)
-        road_track.generate_measurement()
-        if args.noresample:
-            road_track.fake_resample()
+        self.move_particles(t)
+        self.generate_measurement()
+        if resample:
+            self.score_particles()
+            resampled = self.resample()
         else:
-            road_track.score_particles()
-            road_track.resample()
+            self.fake_resample()
+            resampled = False
 
         # common (progress time)
-        road_track.advance_time(delta_t)
+        self.advance_time(t)
+        return resampled
+
+class RoadTrackDisplay:
+    def __init__(self, sim, display_measurement,
+                 max_points = default_max_points, density = 'sample',
+                 histogram_bins = 200, blit = True):
+        # the road is drawn once into a cached background; every frame
+        # restores it and draws only the animated artists on top (when
+        # the backend can blit). Without blitting the dynamic artists are
+        # ordinary ones that every full draw renders. Past max_points
+        # particles, 'sample' plots an evenly strided subset and
+        # 'histogram' their density.
+        self.sim = sim
+        self.fig, self.ax = plt.subplots()
+        self.blit = blit and self.fig.canvas.supports_blit
+        animated = self.blit
+        self.particle_plot, = self.ax.plot([], [], 'g.', animated=animated)
+        self.gt_plot, = self.ax.plot([], [], 'bx', animated=animated)
+        self.measurement_plot, = self.ax.plot([], [], 'ro',
+                                              animated=animated)
+        self.frame_text = self.ax.text(0.02, 0.98, '', va='top',
+                                       transform=self.ax.transAxes,
+                                       animated=animated)
+        self.display_measurement = display_measurement
+        self.max_points = max_points
+        self.density = density
+        self.histogram_bins = histogram_bins
+        self.plot_road()
+        self.fig.gca().set_aspect('equal', adjustable='box')
+        self.density_plot = self.ax.imshow(
+            np.zeros((1, 1)), extent = (*self.ax.get_xlim(),
+                                        *self.ax.get_ylim()),
+            origin='lower', cmap='Greens', interpolation='nearest',
+            aspect='auto', animated=animated, visible=False)
+        self.artists = [ self.density_plot, self.particle_plot,
+                         self.gt_plot, self.measurement_plot,
+                         self.frame_text ]
+        self.background = None
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self.frame_times = []
+
+    def on_draw(self, event):
+        # a full draw happened (first show, resize): re-cache the static
+        # background and put the animated artists back on top
+        if self.blit:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+            self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def plot_road(self):
+        road_map = self.sim.road_map
+        self.ax.add_collection(PolyCollection(
+            road_map.segment_polygons(), facecolor='0.75', edgecolor='none'))
+        self.ax.plot(*road_map.route.T, color='black', linestyle=':')
+
+        # set the plot limits around the route
+        padding = road_map.max_width() + \
+            np.sqrt(self.sim.measurement_variance)
+        low, high = road_map.route_bounds()
+        self.ax.set_xlim(low[0] - padding, high[0] + padding)
+        self.ax.set_ylim(low[1] - padding, high[1] + padding)
+        self.ax.grid()
+
+    def update_particles(self):
+        particles = self.sim.particles.reshape(-1, 2)
+        n = len(particles)
+        if n > self.max_points and self.density == 'histogram':
+            x_limits = self.ax.get_xlim()
+            y_limits = self.ax.get_ylim()
+            # uniform bins, so a scaled floor and a bincount are enough
+            # (much cheaper than np.histogram2d)
+            bins = self.histogram_bins
+            ix = np.floor((particles[:, 0] - x_limits[0]) *
+                          (bins / (x_limits[1] - x_limits[0])))
+            iy = np.floor((particles[:, 1] - y_limits[0]) *
+                          (bins / (y_limits[1] - y_limits[0])))
+            inside = (ix >= 0) & (ix < bins) & (iy >= 0) & (iy < bins)
+            counts = np.bincount(
+                (iy[inside] * bins + ix[inside]).astype(int),
+                minlength = bins * bins).reshape(bins, bins)
+            self.density_plot.set_data(np.ma.masked_equal(counts, 0))
+            self.density_plot.set_extent((*x_limits, *y_limits))
+            self.density_plot.set_clim(0, counts.max())
+            self.density_plot.set_visible(True)
+            self.particle_plot.set_data([], [])
+            return
+        self.density_plot.set_visible(False)
+        # strided views, no copies of the particle array
+        stride = -(-n // self.max_points)
+        self.particle_plot.set_data(particles[::stride, 0],
+                                    particles[::stride, 1])
+
+    def redraw(self):
+        start = time.perf_counter()
+        sim = self.sim
+        # scalars for a single vehicle, arrays when tracking several
+        self.gt_plot.set_data(np.atleast_1d(sim.gt_x),
+                              np.atleast_1d(sim.gt_y))
+        if self.display_measurement and sim.measurement_x is not None:
+            self.measurement_plot.set_data(np.atleast_1d(sim.measurement_x),
+                                           np.atleast_1d(sim.measurement_y))
+        self.update_particles()
+        if self.frame_times:
+            self.frame_text.set_text('frame {:.1f} ms'.format(
+                1000 * self.frame_times[-1]))
+        canvas = self.fig.canvas
+        if self.blit and self.background is not None:
+            canvas.restore_region(self.background)
+            self.draw_artists()
+            canvas.blit(self.fig.bbox)
+        else:
+            canvas.draw()
+        canvas.flush_events()
+        self.frame_times.append(time.perf_counter() - start)
+
+    def frame_time_report(self):
+        frame_times = 1000 * np.array(self.frame_times)
+        return 'frame time over {} frames: mean {:.2f} ms, max {:.2f} ms' \
+            .format(len(frame_times), frame_times.mean(), frame_times.max())
+
+def display_sleep(now, delta_t):
+    elapsed_wall_clock_time = time.time() - now
+    sleep_time = delta_t - elapsed_wall_clock_time
+    if sleep_time > 0:
+        time.sleep(sleep_time)
+
+def run_headless(sim, delta_t, max_steps, resample = True):
+    # runs the filter as fast as it goes, without any rendering, and
+    # returns one row of estimates and error metrics per step
+    columns = [ 't', 'gt_x', 'gt_y', 'measurement_x', 'measurement_y',
+                'estimate_x', 'estimate_y', 'error', 'ess', 'resampled',
+                'particles', 'step_time' ]
+    rows = []
+    while not sim.done() and (max_steps is None or len(rows) < max_steps):
+        start = time.perf_counter()
+        resampled = sim.step(delta_t, resample)
+        step_time = time.perf_counter() - start
+        estimate_x, estimate_y = sim.get_estimate()
+        rows.append((sim.time, sim.gt_x, sim.gt_y,
+                     sim.measurement_x, sim.measurement_y,
+                     estimate_x, estimate_y,
+                     np.hypot(estimate_x - sim.gt_x, estimate_y - sim.gt_y),
+                     sim.effective_sample_size(), resampled,
+                     sim.num_particles, step_time))
+    return columns, np.array(rows).reshape(-1, len(columns))
 
-    # treat the eyeballs
-    road_track.redraw()
-    if args.step:
-        input()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Simulates the fusion between the map information and GPS.'
+        'The vehicle is assumed to be moving at velocity v following the road.'
+        'It is assumed that the velocity is known with specified variance'
+        'GPS error is modeled as zero-mean Gaussian process with specified variance'
+    )
+    parser.add_argument('--xvert', type=float, default=5,
+                      help='x coordinate of the vertical road segment')
+    parser.add_argument('--yhoriz', type=float, default=10,
+                      help='y coordinate of the horizontal road segment')
+    parser.add_argument('--rwidth', type=float, default=1,
+                      help='road width')
+    parser.add_argument('--map', default=None,
+                        help='JSON road map; replaces the L-shaped corner '
+                        'given by --xvert, --yhoriz and --rwidth')
+    parser.add_argument('--vvel', type=float, default=1,
+                      help='nominal vehicle velocity')
+    parser.add_argument('--vvar', type=float, default=0.2,
+                      help='vehicle velocioty variance')
+    parser.add_argument('--mvar', type=float, default=1,
+                      help='measurement variance')
+    parser.add_argument('--npart', type=int, default=500,
+                      help='number of particles to use')
+    parser.add_argument('--kld', action='store_true',
+                        help='adapt the particle count by KLD-sampling, '
+                        'starting from --npart, whenever the filter '
+                        'resamples; in headless mode the run is repeated '
+                        'with a fixed --npart for comparison')
+    parser.add_argument('--kldmin', type=int, default=100,
+                        help='smallest adaptive particle count')
+    parser.add_argument('--kldmax', type=int, default=10000,
+                        help='largest adaptive particle count')
+    parser.add_argument('--kldeps', type=float, default=default_kld_epsilon,
+                        help='KLD-sampling error bound')
+    parser.add_argument('--klddelta', type=float, default=default_kld_delta,
+                        help='KLD-sampling probability of exceeding the bound')
+    parser.add_argument('--kldbin', type=float, default=default_kld_bin_size,
+                        help='KLD-sampling histogram bin size')
+    parser.add_argument('--randvel', action='store_true',
+                        help='randomize vehicle true velocity')
+    parser.add_argument('--noresample', action='store_true',
+                        help='turn off resampling, reducing the filter prediction')
+    parser.add_argument('--resample', choices=resample_methods,
+                        default='systematic', help='resampling scheme')
+    parser.add_argument('--essthresh', type=float, default=0.5,
+                        help='resample when the effective sample size falls '
+                        'below this fraction of the particle count '
+                        '(1 resamples every step)')
+    parser.add_argument('--step', action='store_true',
+                        help='single-step the filter')
+    parser.add_argument('--maxpoints', type=int, default=default_max_points,
+                        help='most particles drawn individually')
+    parser.add_argument('--density', choices=density_modes, default='sample',
+                        help='past --maxpoints, draw a strided sample of the '
+                        'particles or a 2-D histogram of them')
+    parser.add_argument('--noblit', action='store_true',
+                        help='redraw the whole figure every frame')
+    parser.add_argument('--headless', action='store_true',
+                        help='run without the display, as fast as possible')
+    parser.add_argument('--steps', type=int, default=None,
+                        help='stop after this many steps (headless mode; '
+                        'default runs until the vehicle leaves the road)')
+    parser.add_argument('--output', default=None,
+                        help='CSV file for per-step estimates and errors '
+                        '(headless mode)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    args = parser.parse_args()
+
+    if args.seed is None:
+        # draw a concrete seed, so that the run can be repeated and the
+        # fixed-count comparison below replays the same randomness
+        args.seed = np.random.SeedSequence().entropy
+        print('seed: {}'.format(args.seed))
+    if args.map is not None:
+        road_map = load_map(args.map)
+    else:
+        road_map = default_map(args.xvert, args.yhoriz, args.rwidth)
+    sim_params = dict(
+        road_map = road_map,
+        velocity = args.vvel,
+        velocity_variance = args.vvar,
+        measurement_variance = args.mvar,
+        num_particles = args.npart,
+        randomize_velocity = args.randvel,
+        resample_method = args.resample,
+        resample_threshold = args.essthresh,
+        seed = args.seed)
+    road_track = RoadTrackSim(
+        min_particles = args.kldmin if args.kld else None,
+        max_particles = args.kldmax if args.kld else None,
+        kld_epsilon = args.kldeps,
+        kld_delta = args.klddelta,
+        kld_bin_size = args.kldbin,
+        **sim_params)
+    delta_t = 0.1
+
+    if args.headless:
+        start = time.time()
+        columns, rows = run_headless(road_track, delta_t, args.steps,
+                                     not args.noresample)
+        elapsed = time.time() - start
+        if args.output is not None:
+            np.savetxt(args.output, rows, delimiter = ',',
+                       header = ','.join(columns), comments = '')
+        print('{} steps in {:.2f} s ({:.1f} steps/s), position RMSE {:.4f}'
+              .format(len(rows), elapsed,
+                      len(rows) / elapsed if elapsed > 0 else float('inf'),
+                      np.sqrt(np.mean(rows[:, 7] ** 2))
+                      if len(rows) else float('nan')))
+        if args.kld and len(rows):
+            counts = rows[:, 10]
+            print('particles per step: mean {:.0f}, min {:.0f}, max {:.0f}'
+                  .format(counts.mean(), counts.min(), counts.max()))
+            # the same run (same seed, same number of steps) with the
+            # particle count fixed at --npart, for a measured comparison
+            start = time.time()
+            _, fixed_rows = run_headless(RoadTrackSim(**sim_params), delta_t,
+                                         len(rows), not args.noresample)
+            fixed_elapsed = time.time() - start
+            print('fixed {} particles: {:.2f} s, position RMSE {:.4f}; '
+                  'KLD-sampling saved {:.2f} s'.format(
+                      args.npart, fixed_elapsed,
+                      np.sqrt(np.mean(fixed_rows[:, 7] ** 2)),
+                      fixed_elapsed - elapsed))
     else:
-        display_sleep(now)
+        display = RoadTrackDisplay(road_track,
+                                   display_measurement = not args.noresample,
+                                   max_points = args.maxpoints,
+                                   density = args.density,
+                                   blit = not args.noblit)
+
+        # enter interactive mode and show the plot
+        plt.ion()
+        plt.show()
+
+        if args.step:
+            print('single step mode, press ENTER to advance the simulation')
+        reported = False
+        while True:
+            now = time.time()
+            if not road_track.done():
+                road_track.step(delta_t, not args.noresample)
+            elif not reported:
+                print(display.frame_time_report())
+                reported = True
+
+            # treat the eyeballs
+            display.redraw()
+            if args.step:
+                input()
+            else:
+                display_sleep(now, delta_t)
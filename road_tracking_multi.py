@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+import matplotlib.pyplot as plt
+from road_tracking import RoadTrackDisplay, initial_particles, \
+    move_on_road, log_likelihood, normalize_log_weights, \
+    effective_sample_size, weighted_mean, resample_indices, \
+    resample_methods, display_sleep, default_max_points, density_modes
+from road_map import default_map, load_map
+import argparse
+import time
+import numpy as np
+
+class MultiTargetRoadTrackSim:
+    def __init__(self, road_map, num_targets,
+                 velocity, velocity_variance, measurement_variance,
+                 num_particles, randomize_velocity,
+                 resample_method = 'systematic', resample_threshold = 0.5,
+                 seed = None):
+        # num_targets vehicles on the same map, each with its own
+        # num_particles particle filter; all filters live in one
+        # (M, N, 2) particle array and every step runs the particle-set
+        # steps of road_tracking batched across them. Vehicles drive the
+        # map route one after another, spread over its first half, and
+        # every one gets its own position fix.
+        self.rng = np.random.default_rng(seed)
+        self.road_map = road_map
+        self.num_targets = num_targets
+        self.num_particles = num_particles
+        self.velocity = velocity
+        self.velocity_variance = velocity_variance
+        self.randomize_velocity = randomize_velocity
+        self.measurement_variance = measurement_variance
+        self.resample_method = resample_method
+        self.resample_threshold = resample_threshold
+        self.resample_count = 0
+        self.time = 0
+        self.route_distance = np.arange(num_targets) * \
+            road_map.route_length / (2 * num_targets)
+        self.gt_x, self.gt_y = road_map.route_position(self.route_distance).T
+        self.measurement_x = None
+        self.measurement_y = None
+        self.init_particles(var = 1)
+
+    def init_particles(self, var):
+        m, n = self.num_targets, self.num_particles
+        self.particles = initial_particles(
+            self.road_map, np.column_stack([ self.gt_x, self.gt_y ]), n,
+            var, self.rng)
+        self.log_importance = np.zeros((m, n))
+        self.particle_importance = np.full((m, n), 1 / n)
+
+    def active(self):
+        # targets still driving; the ones that reached the end of the
+        # route stay parked there
+        return self.route_distance < self.road_map.route_length
+
+    def done(self):
+        return not np.any(self.active())
+
+    def move_vehicles(self, time):
+        if self.randomize_velocity:
+            velocity = self.rng.normal(loc = self.velocity,
+                                       scale = np.sqrt(self.velocity_variance),
+                                       size = self.num_targets)
+        else:
+            velocity = self.velocity
+        delta_t = time - self.time
+        self.route_distance = np.where(
+            self.active(),
+            np.minimum(self.route_distance + velocity * delta_t,
+                       self.road_map.route_length),
+            self.route_distance)
+        self.gt_x, self.gt_y = \
+            self.road_map.route_position(self.route_distance).T
+
+    def move_particles(self, time):
+        # one motion model call over the particles of every target
+        delta_t = time - self.time
+        self.predicted_particles = move_on_road(
+            self.road_map, self.particles, self.velocity * delta_t,
+            np.sqrt(self.velocity_variance) * delta_t, self.rng)
+
+    def generate_measurements(self):
+        noise = self.rng.normal(scale = np.sqrt(self.measurement_variance),
+                                size = (2, self.num_targets))
+        self.measurement_x = self.gt_x + noise[0]
+        self.measurement_y = self.gt_y + noise[1]
+
+    def score_particles(self):
+        # per-target normalization along the particle axis
+        self.log_importance = self.log_importance + log_likelihood(
+            self.predicted_particles, self.measurement_x[:, None],
+            self.measurement_y[:, None], self.measurement_variance)
+        self.particle_importance = normalize_log_weights(self.log_importance)
+
+    def effective_sample_size(self):
+        # (M,) effective sample sizes
+        return effective_sample_size(self.particle_importance)
+
+    def resample(self):
+        # only the targets whose effective sample size dropped below the
+        # threshold are resampled, all of them in one batch
+        rows = np.flatnonzero(self.effective_sample_size() <
+                              self.resample_threshold * self.num_particles)
+        self.particles = self.predicted_particles
+        if rows.size:
+            sample_indices = resample_indices[self.resample_method](
+                self.particle_importance[rows], self.rng)
+            self.particles[rows] = np.take_along_axis(
+                self.predicted_particles[rows], sample_indices[..., None],
+                axis = 1)
+            self.log_importance[rows] = 0
+            self.particle_importance[rows] = 1 / self.num_particles
+            self.resample_count += len(rows)
+        return rows
+
+    def get_estimate(self):
+        # (M, 2) weighted means
+        return weighted_mean(self.particle_importance, self.particles)
+
+    def step(self, delta_t):
+        t = self.time + delta_t
+        self.move_vehicles(t)
+        self.move_particles(t)
+        self.generate_measurements()
+        self.score_particles()
+        resampled = self.resample()
+        self.time = t
+        return resampled
+
+def run_headless(sim, delta_t, max_steps):
+    # one row per target and step, for the targets that were still
+    # driving at the start of the step
+    columns = [ 't', 'target', 'gt_x', 'gt_y', 'estimate_x', 'estimate_y',
+                'error', 'ess' ]
+    rows = []
+    targets = np.arange(sim.num_targets)
+    steps = 0
+    while not sim.done() and (max_steps is None or steps < max_steps):
+        active = sim.active()
+        sim.step(delta_t)
+        estimate = sim.get_estimate()
+        error = np.hypot(estimate[:, 0] - sim.gt_x, estimate[:, 1] - sim.gt_y)
+        rows.append(np.column_stack([
+            np.full(sim.num_targets, sim.time), targets, sim.gt_x, sim.gt_y,
+            estimate, error, sim.effective_sample_size() ])[active])
+        steps += 1
+    rows = np.concatenate(rows) if rows else np.empty((0, len(columns)))
+    return columns, rows, steps
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Tracks several vehicles driving the same road map, '
+        'one particle filter per vehicle, with all filters batched in a '
+        'single (targets x particles) array and drawn on one figure.')
+    parser.add_argument('--targets', type=int, default=5,
+                        help='number of vehicles')
+    parser.add_argument('--xvert', type=float, default=5,
+                        help='x coordinate of the vertical road segment')
+    parser.add_argument('--yhoriz', type=float, default=10,
+                        help='y coordinate of the horizontal road segment')
+    parser.add_argument('--rwidth', type=float, default=1,
+                        help='road width')
+    parser.add_argument('--map', default=None,
+                        help='JSON road map; replaces the L-shaped corner')
+    parser.add_argument('--vvel', type=float, default=1,
+                        help='nominal vehicle velocity')
+    parser.add_argument('--vvar', type=float, default=0.2,
+                        help='vehicle velocity variance')
+    parser.add_argument('--mvar', type=float, default=1,
+                        help='measurement variance')
+    parser.add_argument('--npart', type=int, default=500,
+                        help='number of particles per vehicle')
+    parser.add_argument('--randvel', action='store_true',
+                        help='randomize vehicle true velocities')
+    parser.add_argument('--resample', choices=resample_methods,
+                        default='systematic', help='resampling scheme')
+    parser.add_argument('--essthresh', type=float, default=0.5,
+                        help='resample a vehicle\'s filter when its effective '
+                        'sample size falls below this fraction of --npart')
+    parser.add_argument('--headless', action='store_true',
+                        help='run without the display, as fast as possible')
+    parser.add_argument('--steps', type=int, default=None,
+                        help='stop after this many steps (headless mode)')
+    parser.add_argument('--output', default=None,
+                        help='CSV file for per-vehicle, per-step estimates '
+                        '(headless mode)')
+    parser.add_argument('--maxpoints', type=int, default=default_max_points,
+                        help='most particles drawn individually')
+    parser.add_argument('--density', choices=density_modes, default='sample',
+                        help='past --maxpoints, draw a strided sample of the '
+                        'particles or a 2-D histogram of them')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    args = parser.parse_args()
+
+    if args.map is not None:
+        road_map = load_map(args.map)
+    else:
+        road_map = default_map(args.xvert, args.yhoriz, args.rwidth)
+    sim = MultiTargetRoadTrackSim(
+        road_map = road_map,
+        num_targets = args.targets,
+        velocity = args.vvel,
+        velocity_variance = args.vvar,
+        measurement_variance = args.mvar,
+        num_particles = args.npart,
+        randomize_velocity = args.randvel,
+        resample_method = args.resample,
+        resample_threshold = args.essthresh,
+        seed = args.seed)
+    delta_t = 0.1
+
+    if args.headless:
+        start = time.time()
+        columns, rows, steps = run_headless(sim, delta_t, args.steps)
+        elapsed = time.time() - start
+        if args.output is not None:
+            np.savetxt(args.output, rows, delimiter = ',',
+                       header = ','.join(columns), comments = '')
+        rate = steps / elapsed if elapsed > 0 else float('inf')
+        print('{} targets, {} steps in {:.2f} s: {:.1f} steps/s, '
+              '{:.1f} target-steps/s, position RMSE {:.4f}'.format(
+                  args.targets, steps, elapsed, rate, rate * args.targets,
+                  np.sqrt(np.mean(rows[:, 6] ** 2))
+                  if len(rows) else float('nan')))
+    else:
+        display = RoadTrackDisplay(sim, display_measurement = True,
+                                   max_points = args.maxpoints,
+                                   density = args.density)
+        plt.ion()
+        plt.show()
+        steps = 0
+        start = time.time()
+        reported = False
+        while True:
+            now = time.time()
+            if not sim.done():
+                sim.step(delta_t)
+                steps += 1
+            elif not reported:
+                elapsed = time.time() - start
+                print('{:.1f} target-steps/s including display, {}'.format(
+                    steps * args.targets / elapsed,
+                    display.frame_time_report()))
+                reported = True
+            display.redraw()
+            display_sleep(now, delta_t)
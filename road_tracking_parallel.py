@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+from road_tracking import RoadTrackSim, move_on_road, log_likelihood, \
+    run_headless
+from road_map import default_map, load_map
+from multiprocessing import shared_memory
+import multiprocessing
+import argparse
+import os
+import time
+import numpy as np
+
+def _worker(connection, names, num_particles, lo, hi, road_map, seed):
+    # owns particles [lo, hi) of both shared buffers and the log weights
+    # of those particles; only commands and per-shard sums go through the
+    # pipe, particle data stays in shared memory
+    blocks = [ shared_memory.SharedMemory(name = name) for name in names ]
+    buffers = [ np.ndarray((num_particles, 2), buffer = block.buf)
+                for block in blocks ]
+    rng = np.random.default_rng(seed)
+    log_importance = np.zeros(hi - lo)
+    importance = None
+    try:
+        while True:
+            command, *params = connection.recv()
+            if command == 'move':
+                source, target, step, std = params
+                buffers[target][lo:hi] = move_on_road(
+                    road_map, buffers[source][lo:hi], step, std, rng)
+                connection.send(None)
+            elif command == 'score':
+                # weights relative to the local peak; the caller rescales
+                # every shard to the global one
+                target, measurement_x, measurement_y, \
+                    measurement_variance = params
+                predicted = buffers[target][lo:hi]
+                log_importance += log_likelihood(
+                    predicted, measurement_x, measurement_y,
+                    measurement_variance)
+                peak = log_importance.max()
+                importance = np.exp(log_importance - peak)
+                connection.send((peak, importance.sum(),
+                                 importance @ importance,
+                                 importance @ predicted))
+            elif command == 'resample':
+                # this shard's share of a global systematic resampling:
+                # positions first to last fall within its cumulative weight
+                # range and their particles land in slots first to last
+                source, target, offset, first, last, start, scale = params
+                cumulative = np.cumsum(importance)
+                cumulative *= scale
+                cumulative += start
+                positions = (offset + np.arange(first, last)) / num_particles
+                sample_indices = np.minimum(
+                    np.searchsorted(cumulative, positions), hi - lo - 1)
+                np.take(buffers[source][lo:hi], sample_indices, axis = 0,
+                        out = buffers[target][first:last])
+                log_importance.fill(0)
+                connection.send(None)
+            elif command == 'reset':
+                target, = params
+                log_importance.fill(0)
+                connection.send(buffers[target][lo:hi].sum(axis = 0))
+            else:
+                break
+    finally:
+        del buffers
+        for block in blocks:
+            block.close()
+
+class ParallelRoadTrackSim(RoadTrackSim):
+    def __init__(self, road_map,
+                 velocity, velocity_variance, measurement_variance,
+                 num_particles, randomize_velocity,
+                 resample_threshold = 0.5, seed = None, num_workers = None):
+        # RoadTrackSim with the particles split into contiguous shards,
+        # one per worker process, in two shared memory buffers that swap
+        # roles between the particle set and its prediction. Resampling
+        # is systematic and global: the parent turns per-shard weight sums
+        # into each shard's range of output slots.
+        self.num_workers = min(num_workers or os.cpu_count(), num_particles)
+        self.seed = seed
+        super().__init__(road_map, velocity, velocity_variance,
+                         measurement_variance, num_particles,
+                         randomize_velocity,
+                         resample_method = 'systematic',
+                         resample_threshold = resample_threshold,
+                         seed = seed)
+
+    def init_particles(self, var):
+        particles = self.initial_particles(var)
+        n = self.num_particles
+        self._blocks = [ shared_memory.SharedMemory(
+            create = True, size = particles.nbytes) for _ in range(2) ]
+        self._buffers = [ np.ndarray((n, 2), buffer = block.buf)
+                          for block in self._blocks ]
+        self._buffers[0][:] = particles
+        self.current = 0
+        self.particles = self._buffers[0]
+        self._ess = n
+        self._estimate = particles.mean(axis = 0)
+        bounds = np.linspace(0, n, self.num_workers + 1).astype(int)
+        seeds = np.random.SeedSequence(self.seed).spawn(self.num_workers)
+        names = [ block.name for block in self._blocks ]
+        self._connections = []
+        self._workers = []
+        for i in range(self.num_workers):
+            parent, child = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target = _worker,
+                args = (child, names, n, bounds[i], bounds[i + 1],
+                        self.road_map, seeds[i]),
+                daemon = True)
+            worker.start()
+            self._connections.append(parent)
+            self._workers.append(worker)
+
+    def _broadcast(self, messages):
+        for connection, message in zip(self._connections, messages):
+            connection.send(message)
+        return [ connection.recv() for connection in self._connections ]
+
+    def move_particles(self, time):
+        delta_t = time - self.time
+        self._broadcast(
+            [ ('move', self.current, 1 - self.current,
+               self.velocity * delta_t,
+               np.sqrt(self.velocity_variance) * delta_t) ] *
+            self.num_workers)
+        self.predicted_particles = self._buffers[1 - self.current]
+
+    def score_particles(self):
+        replies = self._broadcast(
+            [ ('score', 1 - self.current, self.measurement_x,
+               self.measurement_y, self.measurement_variance) ] *
+            self.num_workers)
+        peaks = np.array([ r[0] for r in replies ])
+        # bring every shard's sums to the global peak (log-sum-exp)
+        scale = np.exp(peaks - peaks.max())
+        sums = np.array([ r[1] for r in replies ]) * scale
+        squares = np.array([ r[2] for r in replies ]) * scale * scale
+        moments = np.array([ r[3] for r in replies ]) * scale[:, None]
+        total = sums.sum()
+        self._shard_mass = sums / total
+        self._shard_scale = scale / total
+        self._ess = total * total / squares.sum()
+        self._estimate = moments.sum(axis = 0) / total
+
+    def effective_sample_size(self):
+        return self._ess
+
+    def get_estimate(self):
+        # weighted mean of the prediction, before any resampling
+        return self._estimate
+
+    def resample(self):
+        if self._ess >= self.resample_threshold * self.num_particles:
+            # weights are still healthy, workers keep them
+            self.current = 1 - self.current
+            self.particles = self._buffers[self.current]
+            return False
+        n = self.num_particles
+        offset = self.rng.random()
+        start = np.concatenate([ [0], np.cumsum(self._shard_mass)[:-1] ])
+        first = np.clip(np.ceil(start * n - offset), 0, n).astype(int)
+        last = np.append(first[1:], n)
+        self._broadcast(
+            [ ('resample', 1 - self.current, self.current, offset,
+               first[i], last[i], start[i], self._shard_scale[i])
+              for i in range(self.num_workers) ])
+        self.particles = self._buffers[self.current]
+        self._ess = n
+        self.resample_count += 1
+        return True
+
+    def fake_resample(self):
+        self.current = 1 - self.current
+        self.particles = self._buffers[self.current]
+        sums = self._broadcast([ ('reset', self.current) ] * self.num_workers)
+        self._ess = self.num_particles
+        self._estimate = np.sum(sums, axis = 0) / self.num_particles
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('stop',))
+        for worker in self._workers:
+            worker.join()
+        del self.particles, self.predicted_particles, self._buffers
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+def time_run(sim, delta_t, num_steps):
+    start = time.perf_counter()
+    columns, rows = run_headless(sim, delta_t, num_steps)
+    elapsed = time.perf_counter() - start
+    return len(rows), elapsed, np.sqrt(np.mean(rows[:, 7] ** 2))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Scaling benchmark for the multi-process road tracking '
+        'particle filter: runs the same headless simulation with the '
+        'particles sharded over 1 to all cores and reports steps/s and '
+        'speedup against a single worker and the single-process filter.')
+    parser.add_argument('--npart', type=int, default=1000000,
+                        help='number of particles')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='filter steps per run')
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help='worker counts to run (default 1, 2, 4, ... '
+                        'and the core count)')
+    parser.add_argument('--map', default=None,
+                        help='JSON road map (default is the L-shaped corner)')
+    parser.add_argument('--vvel', type=float, default=1,
+                        help='nominal vehicle velocity')
+    parser.add_argument('--vvar', type=float, default=0.2,
+                        help='vehicle velocity variance')
+    parser.add_argument('--mvar', type=float, default=1,
+                        help='measurement variance')
+    parser.add_argument('--essthresh', type=float, default=0.5,
+                        help='effective sample size resampling threshold')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    args = parser.parse_args()
+
+    road_map = load_map(args.map) if args.map is not None else \
+        default_map(5, 10, 1)
+    delta_t = 0.1
+    worker_counts = args.workers
+    if worker_counts is None:
+        cores = os.cpu_count()
+        worker_counts = sorted(set(
+            [ 2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores ] +
+            [ cores ]))
+
+    sim = RoadTrackSim(road_map, args.vvel, args.vvar, args.mvar, args.npart,
+                       False, resample_threshold = args.essthresh,
+                       seed = args.seed)
+    steps, elapsed, rmse = time_run(sim, delta_t, args.steps)
+    del sim
+    serial_rate = steps / elapsed
+    print('{:>8} {:>10} {:>14} {:>8} {:>10} {:>8}'.format(
+        'workers', 'steps/s', 'particles/s', 'speedup', 'efficiency',
+        'RMSE'))
+    print('{:>8} {:>10.2f} {:>14.3g} {:>8} {:>10} {:>8.4f}'.format(
+        'serial', serial_rate, serial_rate * args.npart, '', '', rmse))
+    base_rate = None
+    for workers in worker_counts:
+        sim = ParallelRoadTrackSim(road_map, args.vvel, args.vvar, args.mvar,
+                                   args.npart, False,
+                                   resample_threshold = args.essthresh,
+                                   seed = args.seed, num_workers = workers)
+        try:
+            steps, elapsed, rmse = time_run(sim, delta_t, args.steps)
+        finally:
+            sim.close()
+        rate = steps / elapsed
+        if base_rate is None:
+            base_rate = rate
+        print('{:>8} {:>10.2f} {:>14.3g} {:>8.2f} {:>10.2f} {:>8.4f}'.format(
+            workers, rate, rate * args.npart, rate / base_rate,
+            rate / base_rate / workers, rmse))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+from road_tracking import RoadTrackSim, run_headless, resample_methods
+from road_map import default_map
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+import numpy as np
+
+# parameters swept over a grid; every other trial parameter is fixed for
+# the whole sweep
+sweep_parameters = [ 'npart', 'mvar', 'vvar', 'rwidth' ]
+
+# bump whenever a change to the filter, the road map or run_trial changes
+# the results of a trial, so cached results of the old code are rerun
+# rather than reused (removing the --cache directory works too)
+cache_version = 2
+
+def trial_key(params):
+    return hashlib.sha1(json.dumps([ cache_version, params ],
+                                   sort_keys = True).encode()).hexdigest()
+
+def run_trial(params):
+    # one headless run; the seed depends only on the root seed and the
+    # trial number, so every grid point sees the same random streams
+    road_map = default_map(params['xvert'], params['yhoriz'],
+                           params['rwidth'])
+    sim = RoadTrackSim(
+        road_map = road_map,
+        velocity = params['vvel'],
+        velocity_variance = params['vvar'],
+        measurement_variance = params['mvar'],
+        num_particles = params['npart'],
+        randomize_velocity = params['randvel'],
+        resample_method = params['resample'],
+        resample_threshold = params['essthresh'],
+        seed = np.random.SeedSequence([ params['seed'], params['trial'] ]))
+    start = time.perf_counter()
+    _, rows = run_headless(sim, params['tstep'], params['steps'])
+    elapsed = time.perf_counter() - start
+    if not len(rows):
+        # --steps 0, or a route that is already driven
+        return { 'steps': 0, 'rmse': float('nan'),
+                 'time_per_step': float('nan') }
+    return {
+        'steps': len(rows),
+        'rmse': float(np.sqrt(np.mean(rows[:, 7] ** 2))),
+        'time_per_step': elapsed / len(rows),
+    }
+
+def load_cached(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, key + '.json')) as f:
+            return json.load(f)['result']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def store_cached(cache_dir, key, params, result):
+    # write then rename so an interrupted sweep leaves no partial entry
+    path = os.path.join(cache_dir, key + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({ 'params': params, 'result': result }, f)
+    os.replace(path + '.tmp', path)
+
+def sweep(grid, fixed, num_trials, cache_dir, num_workers):
+    # grid maps each swept parameter to its values; returns the trial
+    # results of every grid point in grid order. Repeated values are
+    # dropped, they would give grid points with the same trials.
+    grid = { name: list(dict.fromkeys(values))
+             for name, values in grid.items() }
+    points = [ dict(zip(grid, values))
+               for values in itertools.product(*grid.values()) ]
+    trials = {}
+    pending = {}
+    for i, point in enumerate(points):
+        for trial in range(num_trials):
+            params = dict(fixed, trial = trial, **point)
+            key = trial_key(params)
+            result = load_cached(cache_dir, key)
+            if result is None:
+                pending[key] = (i, params)
+            else:
+                trials.setdefault(i, []).append(result)
+    cached = sum(len(t) for t in trials.values())
+    print('{} grid points, {} trials: {} cached, {} to run'.format(
+        len(points), len(points) * num_trials, cached, len(pending)))
+    if pending:
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            futures = { executor.submit(run_trial, params): key
+                        for key, (_, params) in pending.items() }
+            for future in as_completed(futures):
+                key = futures[future]
+                i, params = pending[key]
+                result = future.result()
+                store_cached(cache_dir, key, params, result)
+                trials.setdefault(i, []).append(result)
+    return points, [ trials[i] for i in range(len(points)) ]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Parameter sweep for the road tracking particle '
+        'filter: runs headless trials for every point of a parameter grid '
+        'in a process pool and tabulates position RMSE and time per step. '
+        'Trial results are cached on disk keyed by a hash of their '
+        'parameters, so re-running a sweep only runs new points.')
+    parser.add_argument('--npart', type=int, nargs='+', default=[500],
+                        help='particle counts to sweep')
+    parser.add_argument('--mvar', type=float, nargs='+', default=[1],
+                        help='measurement variances to sweep')
+    parser.add_argument('--vvar', type=float, nargs='+', default=[0.2],
+                        help='vehicle velocity variances to sweep')
+    parser.add_argument('--rwidth', type=float, nargs='+', default=[1],
+                        help='road widths to sweep')
+    parser.add_argument('--xvert', type=float, default=5,
+                        help='x coordinate of the vertical road segment')
+    parser.add_argument('--yhoriz', type=float, default=10,
+                        help='y coordinate of the horizontal road segment')
+    parser.add_argument('--vvel', type=float, default=1,
+                        help='nominal vehicle velocity')
+    parser.add_argument('--randvel', action='store_true',
+                        help='randomize vehicle true velocity')
+    parser.add_argument('--resample', choices=resample_methods,
+                        default='systematic', help='resampling scheme')
+    parser.add_argument('--essthresh', type=float, default=0.5,
+                        help='effective sample size resampling threshold')
+    parser.add_argument('--steps', type=int, default=None,
+                        help='steps per trial (default runs until the '
+                        'vehicle leaves the road)')
+    parser.add_argument('--tstep', type=float, default=0.1,
+                        help='time step')
+    parser.add_argument('--trials', type=int, default=10,
+                        help='trials per grid point')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='root seed')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--cache', default='road_tracking_sweep_cache',
+                        help='directory for cached trial results '
+                        '(remove it to rerun every trial)')
+    parser.add_argument('--output', default=None,
+                        help='CSV file for the result table')
+    args = parser.parse_args()
+
+    os.makedirs(args.cache, exist_ok = True)
+    grid = { name: getattr(args, name) for name in sweep_parameters }
+    fixed = { name: getattr(args, name)
+              for name in [ 'xvert', 'yhoriz', 'vvel', 'randvel', 'resample',
+                            'essthresh', 'steps', 'tstep', 'seed' ] }
+    start = time.time()
+    points, trials = sweep(grid, fixed, args.trials, args.cache, args.workers)
+    elapsed = time.time() - start
+
+    columns = sweep_parameters + [ 'rmse_mean', 'rmse_std',
+                                   'ms_per_step', 'steps' ]
+    table = []
+    for point, results in zip(points, trials):
+        rmse = np.array([ r['rmse'] for r in results ])
+        table.append([ point[name] for name in sweep_parameters ] +
+                     [ rmse.mean(), rmse.std(),
+                       1000 * np.mean([ r['time_per_step'] for r in results ]),
+                       np.mean([ r['steps'] for r in results ]) ])
+    print(''.join('{:>12}'.format(c) for c in columns))
+    for row in table:
+        print(''.join('{:>12.6g}'.format(v) for v in row))
+    print('sweep took {:.2f} s'.format(elapsed))
+    if args.output is not None:
+        np.savetxt(args.output, np.array(table), delimiter = ',',
+                   header = ','.join(columns), comments = '')
@@ -18,23 +18,14 @@ t_step = 0.1
 
 botkf = CartesianBotKF(K, J, b, R, L, r)
 botkf.set_state(0)
-t = t_step
-all_omega_x = []
-all_omega_y = []
-all_pos_x = []
-all_pos_y = []
-all_t = [i * t_step for i in range(1, 101)]
-for t in all_t:
-    vx = 10 if t < 4 else 0
-    vy = 5 if t < 7 and t > 2 else 0
-    botkf.simulate_system(t, vx, vy)
-    omega_x, omega_y = botkf.peek_omega()
-    pos_x, pos_y = botkf.peek_pos()
-    all_omega_x.append(omega_x)
-    all_omega_y.append(omega_y)
-    all_pos_x.append(pos_x)
-    all_pos_y.append(pos_y)
-    i_x, _ = botkf.peek_current()
+all_t = numpy.arange(1, 101) * t_step
+vx = numpy.where(all_t < 4, 10, 0)
+vy = numpy.where((all_t < 7) & (all_t > 2), 5, 0)
+states = botkf.simulate_trajectory(all_t, vx, vy)
+all_omega_x = states[:, 1]
+all_omega_y = states[:, 4]
+all_pos_x = states[:, 0]
+all_pos_y = states[:, 3]
 plt.subplot(221)
 plt.plot(all_t, all_omega_x)
 plt.grid()
@@ -1,105 +1,291 @@
 #!/usr/bin/env python
 import argparse
 import json
+import time
 import numpy as np
 
-parser = argparse.ArgumentParser(
-    description = 'Runs value-iteration algorithm on a grid of '
-    'specified size assuming the motion model that makes the robot '
-    'move in the specified direction with probability 1 - n * p '
-    'where p is the probability of skidding or slipping and moving in '
-    'one of other possible directions.')
-parser.add_argument('--gamma', '-g', type=float, default = 0.9,
-                    help='discount factor gamma')
-parser.add_argument('--xgrid', '-x', type=int, default = 4,
-                    help='grid size in x-dimension')
-parser.add_argument('--ygrid', '-y', type=int, default = 4,
-                    help='grid size in y-dimension')
-parser.add_argument('--probslip', '-p', type=float, default = 0.1,
-                    help='slip/skid probability')
-parser.add_argument('--movecost', '-m', type=float, default = 1,
-                    help='cost of moving')
-parser.add_argument('--epsilon', '-e', type=float, default = 1e-3,
-                    help='epsilon for convergence criteria')
-parser.add_argument('--termstates', '-t', type=str,
-                    default = 'terminal_states.json',
-                    help = 'list of terminal states costs')
-args = parser.parse_args()
-
-with open(args.termstates) as f:
-    terminal_states = json.load(f)
-
-def terminal_state(x, y):
+# neighbor (and control) order: left, right, top (y - 1), bottom (y + 1)
+directions = [ (-1, 0), (1, 0), (0, -1), (0, 1) ]
+
+modes = [ 'jacobi', 'gauss-seidel', 'prioritized' ]
+
+# prioritized sweeping backs up, in one batch, the cells with the
+# largest bounds on their Bellman errors, this fraction of the grid.
+# It is an experiment in backup counts: the batches are gathered and
+# scattered by index, which costs several times a full-grid sweep per
+# backup, so it is slower than jacobi and gauss-seidel in wall time
+priority_batch_fraction = 0.1
+
+def load_terminal_states(path):
+    with open(path) as f:
+        return json.load(f)
+
+def terminal_grid(terminal_states, xgrid, ygrid):
+    # grid of terminal values (zero elsewhere) and mask of the cells held
+    # fixed; the first entry for a cell wins and, as with the per-cell
+    # 'if not terminal_state(x, y)' check, a terminal worth 0 is backed
+    # up like any other cell
+    values = np.zeros((xgrid, ygrid))
+    seen = np.zeros((xgrid, ygrid), dtype = bool)
     for ts in terminal_states:
-        if x == ts['x'] and y == ts['y']:
-            return ts['value']
-    return None
-
-def init_values():
-    values = np.zeros((args.xgrid, args.ygrid))
-    for x in range(args.xgrid):
-        for y in range(args.ygrid):
-            v = terminal_state(x, y)
-            if v is not None:
-                values[x, y] = v
-    return values
-
-def get_neighbors(x, y):
-    neighbors = []
-    # left neighbor
-    if x-1 >=0:
-        neighbors.append((x-1, y))
-    # right neighbor
-    if x+1 < args.xgrid:
-        neighbors.append((x+1, y))
-    # top neighbor
-    if y-1 >=0:
-        neighbors.append((x, y-1))
-    if y+1 < args.ygrid:
-        neighbors.append((x, y+1))
-    return neighbors
-
-def get_motion_distro(neighbors):
-    move_prob = 1 - (len(neighbors) - 1) * args.probslip
-    distro = []
-    for n in range(len(neighbors)):
-        d = [ args.probslip ] * len(neighbors)
-        d[n] = move_prob
-        distro.append(d)
-    return distro
-
-def iterate(values):
-    new_values = init_values()
-    for x in range(args.xgrid):
-        for y in range(args.ygrid):
-            if not terminal_state(x, y):
-                neighbors = get_neighbors(x, y)
-                motion_distro = get_motion_distro(neighbors)
-                motion_candidate_values = []
-                # outer loop iterates over control options
-                for i in range(len(neighbors)):
-                    # inner loop calculates expected V
-                    p_x_given_u = motion_distro[i]
-                    expected_V = 0
-                    for j in range(len(neighbors)):
-                        expected_V += values[neighbors[j]] * p_x_given_u[j]
-                    motion_candidate_values.append(
-                        (expected_V - args.movecost)
-                    )
-                new_values[x, y] = args.gamma * max(motion_candidate_values)
-    return new_values
-
-iteration_count=0
-values = init_values()
-print('Init')
-print(values)
-print('')
-delta = float('inf')
-while delta > args.epsilon:
-    iteration_count+=1
-    print('Iteration {}'.format(iteration_count))
-    new_values = iterate(values)
-    delta = np.max(np.abs(new_values - values))
-    values = new_values
-    print(np.round(values, 2))
-    print('')
+        x, y = ts['x'], ts['y']
+        if 0 <= x < xgrid and 0 <= y < ygrid and not seen[x, y]:
+            values[x, y] = ts['value']
+            seen[x, y] = True
+    return values, seen & (values != 0)
+
+class GridBellman:
+    def __init__(self, xgrid, ygrid, terminal_states,
+                 gamma, probslip, movecost):
+        # the robot moves to the neighbor it aims for with probability
+        # 1 - (n - 1) * p and slips to each of its other n - 1 neighbors
+        # with probability p, n being the number of neighbors of the cell
+        self.xgrid = xgrid
+        self.ygrid = ygrid
+        self.gamma = gamma
+        self.probslip = probslip
+        self.movecost = movecost
+        self.terminal_values, self.terminal = terminal_grid(
+            terminal_states, xgrid, ygrid)
+        x = np.arange(xgrid)[:, None]
+        y = np.arange(ygrid)[None, :]
+        self.valid = np.array([
+            np.broadcast_to((x + dx >= 0) & (x + dx < xgrid) &
+                            (y + dy >= 0) & (y + dy < ygrid),
+                            (xgrid, ygrid))
+            for dx, dy in directions ])
+        self.num_neighbors = self.valid.sum(axis = 0)
+        # aiming for neighbor i gives the expected value
+        # p * sum(V[neighbors]) + (1 - n * p) * V[neighbor i]
+        self.aim_weight = 1 - self.num_neighbors * probslip
+        # -inf rules out controls towards a missing neighbor
+        self.invalid = np.where(self.valid, 0, -np.inf)
+        # values with a zero border, so that shifted views of it give
+        # every cell's neighbors and the neighbor sum needs no masking
+        self._padded = np.zeros((xgrid + 2, ygrid + 2))
+        # red-black coloring: all neighbors of a cell have the other
+        # color. For each color, the flat indices of its non-terminal
+        # cells into the values and into the padded values, and their
+        # neighbors' offsets in the padded values
+        red = (x + y) % 2 == 0
+        self._colors = []
+        for color in [ red, ~red ]:
+            cx, cy = np.nonzero(color & ~self.terminal)
+            self._colors.append((
+                cx * ygrid + cy,
+                (cx + 1) * (ygrid + 2) + cy + 1,
+                self.aim_weight[cx, cy],
+                self.invalid[:, cx, cy]))
+        self._offsets = [ dx * (ygrid + 2) + dy for dx, dy in directions ]
+        self.num_backed_up = int((~self.terminal).sum())
+
+    def init_values(self):
+        return self.terminal_values.copy()
+
+    def neighbor_values(self, values):
+        # views of the neighbor values of every cell, one per direction;
+        # zero where there is no neighbor
+        padded = self._padded
+        padded[1:-1, 1:-1] = values
+        return [ padded[1 + dx:padded.shape[0] - 1 + dx,
+                        1 + dy:padded.shape[1] - 1 + dy]
+                 for dx, dy in directions ]
+
+    def backup(self, values):
+        # one synchronous sweep over the whole grid
+        neighbors = self.neighbor_values(values)
+        best = self.aim_weight * neighbors[0] + self.invalid[0]
+        for n, invalid in zip(neighbors[1:], self.invalid[1:]):
+            candidate = self.aim_weight * n
+            candidate += invalid
+            np.maximum(best, candidate, out = best)
+        best += self.probslip * sum(neighbors)
+        best -= self.movecost
+        best *= self.gamma
+        return np.where(self.terminal, self.terminal_values, best)
+
+    def backup_cells(self, flat_padded, padded_cells, aim_weight, invalid):
+        # backed up values of the cells at padded_cells of the flattened
+        # padded values, given their aim weights and (4, n) invalid masks
+        neighbors = [ flat_padded[padded_cells + offset]
+                      for offset in self._offsets ]
+        best = aim_weight * neighbors[0] + invalid[0]
+        for n, inv in zip(neighbors[1:], invalid[1:]):
+            candidate = aim_weight * n
+            candidate += inv
+            np.maximum(best, candidate, out = best)
+        best += self.probslip * sum(neighbors)
+        best -= self.movecost
+        best *= self.gamma
+        return best
+
+    def gauss_seidel_sweep(self, values):
+        # in-place sweep in red-black order; every cell of one color only
+        # depends on cells of the other, so updating a whole color at
+        # once is a Gauss-Seidel update that sees the newest values
+        padded = self._padded
+        padded[1:-1, 1:-1] = values
+        flat_values = values.reshape(-1)
+        flat_padded = padded.reshape(-1)
+        delta = 0
+        for cells, padded_cells, aim_weight, invalid in self._colors:
+            best = self.backup_cells(flat_padded, padded_cells, aim_weight,
+                                     invalid)
+            if len(cells):
+                delta = max(delta, np.max(np.abs(best - flat_values[cells])))
+            flat_values[cells] = best
+            flat_padded[padded_cells] = best
+        return delta
+
+def solve_jacobi(bellman, epsilon, on_iteration = None):
+    # synchronous sweeps into a fresh grid; returns the values and the
+    # number of sweeps and cell backups
+    values = bellman.init_values()
+    sweeps = 0
+    delta = float('inf')
+    while delta > epsilon:
+        new_values = bellman.backup(values)
+        delta = np.max(np.abs(new_values - values))
+        values = new_values
+        sweeps += 1
+        if on_iteration is not None:
+            on_iteration(sweeps, values)
+    return values, sweeps, sweeps * bellman.num_backed_up
+
+def solve_gauss_seidel(bellman, epsilon, on_iteration = None):
+    values = bellman.init_values()
+    sweeps = 0
+    delta = float('inf')
+    while delta > epsilon:
+        delta = bellman.gauss_seidel_sweep(values)
+        sweeps += 1
+        if on_iteration is not None:
+            on_iteration(sweeps, values)
+    return values, sweeps, sweeps * bellman.num_backed_up
+
+def solve_prioritized(bellman, epsilon, on_iteration = None):
+    # prioritized sweeping, batched: every round backs up the cells with
+    # the largest priorities, the top priority_batch_fraction of the grid,
+    # in one vectorized update. A cell's priority bounds its Bellman
+    # error: a backup zeroes it, and a change d of a neighbor's value
+    # raises it by at most gamma * (|1 - n * p| + p) * d, so the cells that
+    # can move into a backed up cell are re-prioritized without being
+    # backed up themselves. Stops once no priority exceeds epsilon.
+    # Reports equivalent sweeps (backups per backed-up cell), counting
+    # the full backup that sets the initial priorities.
+    # This is a batched top-k over the bounds, not a priority queue, and
+    # it only pays off in backup counts: each round rescans the whole
+    # priority array, and the batch is backed up through index gathers
+    # and scatters. On a 700 x 700 grid it takes 80% of the backups of
+    # jacobi, more than gauss-seidel, and 8 times the wall time.
+    values = bellman.init_values()
+    error = np.abs(bellman.backup(values) - values)
+    backups = bellman.num_backed_up
+    # the solver works on the flattened padded values, in which the
+    # neighbors of a cell are at fixed offsets; every per-cell array is
+    # laid out the same way, with zero priorities on the padding
+    padded = bellman._padded
+    padded[1:-1, 1:-1] = values
+    flat_padded = padded.reshape(-1)
+    def pad(grid, fill = 0):
+        padded_grid = np.full(padded.shape, fill, dtype = float)
+        padded_grid[1:-1, 1:-1] = grid
+        return padded_grid.reshape(-1)
+    priority = pad(np.where(bellman.terminal, 0, error))
+    lipschitz = pad(np.where(
+        bellman.terminal, 0,
+        bellman.gamma * (np.abs(bellman.aim_weight) + bellman.probslip)))
+    aim_weight = pad(bellman.aim_weight)
+    invalid = np.array([ pad(inv, -np.inf) for inv in bellman.invalid ])
+    batch_size = max(1, int(priority_batch_fraction * bellman.num_backed_up))
+    batch_size = min(batch_size, len(priority))
+    while True:
+        batch = np.argpartition(priority, -batch_size)[-batch_size:]
+        # in memory order, for locality of the gathers and scatters
+        batch = np.sort(batch[priority[batch] > epsilon])
+        if not len(batch):
+            break
+        best = bellman.backup_cells(flat_padded, batch, aim_weight[batch],
+                                    invalid[:, batch])
+        change = np.abs(best - flat_padded[batch])
+        flat_padded[batch] = best
+        backups += len(batch)
+        priority[batch] = 0
+        # batch cells are distinct, so are their neighbors in any one
+        # direction and a plain fancy-index update accumulates correctly
+        for offset in bellman._offsets:
+            neighbors = batch + offset
+            priority[neighbors] += lipschitz[neighbors] * change
+    values[:] = padded[1:-1, 1:-1]
+    sweeps = backups / max(bellman.num_backed_up, 1)
+    if on_iteration is not None:
+        on_iteration(sweeps, values)
+    return values, sweeps, backups
+
+solvers = {
+    'jacobi': solve_jacobi,
+    'gauss-seidel': solve_gauss_seidel,
+    'prioritized': solve_prioritized,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Runs value-iteration algorithm on a grid of '
+        'specified size assuming the motion model that makes the robot '
+        'move in the specified direction with probability 1 - n * p '
+        'where p is the probability of skidding or slipping and moving in '
+        'one of other possible directions.')
+    parser.add_argument('--gamma', '-g', type=float, default = 0.9,
+                        help='discount factor gamma')
+    parser.add_argument('--xgrid', '-x', type=int, default = 4,
+                        help='grid size in x-dimension')
+    parser.add_argument('--ygrid', '-y', type=int, default = 4,
+                        help='grid size in y-dimension')
+    parser.add_argument('--probslip', '-p', type=float, default = 0.1,
+                        help='slip/skid probability')
+    parser.add_argument('--movecost', '-m', type=float, default = 1,
+                        help='cost of moving')
+    parser.add_argument('--epsilon', '-e', type=float, default = 1e-3,
+                        help='epsilon for convergence criteria')
+    parser.add_argument('--termstates', '-t', type=str,
+                        default = 'terminal_states.json',
+                        help = 'list of terminal states costs')
+    parser.add_argument('--mode', type=str, nargs='+', choices=modes,
+                        default = [ 'jacobi' ],
+                        help = 'value iteration variant(s): synchronous '
+                        'jacobi sweeps, in-place gauss-seidel sweeps or '
+                        'prioritized sweeping (a backup-count experiment, '
+                        'slower than the sweeps in wall time); several '
+                        'are compared')
+    args = parser.parse_args()
+
+    bellman = GridBellman(args.xgrid, args.ygrid,
+                          load_terminal_states(args.termstates),
+                          args.gamma, args.probslip, args.movecost)
+
+    def print_iteration(iteration_count, values):
+        print('Iteration {}'.format(iteration_count))
+        print(np.round(values, 2))
+        print('')
+
+    if len(args.mode) == 1 and args.mode[0] != 'prioritized':
+        print('Init')
+        print(bellman.init_values())
+        print('')
+        on_iteration = print_iteration
+    else:
+        on_iteration = None
+    results = []
+    for mode in args.mode:
+        start = time.time()
+        values, sweeps, backups = solvers[mode](bellman, args.epsilon,
+                                                on_iteration)
+        results.append((mode, values, sweeps, backups, time.time() - start))
+    if on_iteration is None:
+        print(np.round(values, 2))
+        print('')
+    for mode, values, sweeps, backups, elapsed in results:
+        print('{:>12}: {:8.1f} sweeps {:12d} backups {:8.3f} s, '
+              'max difference to {} {:.2e}'.format(
+                  mode, sweeps, backups, elapsed, results[0][0],
+                  np.max(np.abs(values - results[0][1]))))